@@ -0,0 +1,10 @@
+import os
+import tempfile
+
+# Read when trade_log is imported, so set before any test module imports it
+TEST_DIR = tempfile.mkdtemp(prefix='trade_log_test_')
+os.environ['DATABASE_URL'] = 'sqlite:///%s' % os.path.join(TEST_DIR, 'test.db')
+os.environ['DATABASE_REPLICA_URL'] = ''
+os.environ['FRAGMENT_CACHE'] = 'none'
+os.environ['QUOTE_PROVIDER'] = 'none'
+os.environ['ATTACHMENTS_DIR'] = os.path.join(TEST_DIR, 'attachments')
@@ -0,0 +1,66 @@
+import pytest
+
+from trade_log import trade_log
+
+
+@pytest.fixture
+def app(monkeypatch):
+    """The app on an empty database, with empty per-process caches."""
+    trade_log.app.config['TESTING'] = True
+    for name in ('users_cache', 'accounts_cache'):
+        monkeypatch.setattr(trade_log, name, trade_log.LRUCache(trade_log.CACHE_SIZE, trade_log.CACHE_TTL))
+    monkeypatch.setattr(trade_log, 'quote_cache', trade_log.QuoteCache(
+        trade_log.NullQuoteProvider(), trade_log.CACHE_SIZE, trade_log.QUOTE_TTL))
+    engine = trade_log.get_engine()
+    trade_log.metadata.drop_all(engine)
+    trade_log.metadata.create_all(engine)
+    trade_log.upgrade_schema()
+    yield trade_log.app
+    engine.dispose()
+
+
+@pytest.fixture
+def client(app):
+    """A test client signed in as a new user."""
+    client = app.test_client()
+    client.post('/signup', data=dict(username='u', email='u@example.com', password='p', password2='p'))
+    client.post('/signin', data=dict(email='u@example.com', password='p'))
+    return client
+
+
+def location_id(response):
+    return int(response.headers['Location'].rstrip('/').split('/')[-1])
+
+
+@pytest.fixture
+def account_id(client):
+    return location_id(client.post('/accounts/create', data=dict(name='main', cash='10000')))
+
+
+@pytest.fixture
+def add_trade(client, account_id):
+    """Creates a trade through the form, returns its trade_id."""
+    def add_trade(symbol='AAPL'):
+        return location_id(client.post('/accounts/%d/trades/create' % account_id, data=dict(
+            symbol=symbol, target_entry='10', target_profit='12', target_stop='9', entry_reason='x')))
+    return add_trade
+
+
+@pytest.fixture
+def add_order(client, account_id):
+    """Adds an order to a trade through the form."""
+    def add_order(trade_id, type, quantity, price, date='2020-06-18 09:35', commission='0'):
+        response = client.post('/accounts/%d/trades/%d/create' % (account_id, trade_id), data=dict(
+            date=date, type=type, quantity=str(quantity), price=str(price), commission=commission))
+        assert response.status_code == 302
+    return add_order
+
+
+@pytest.fixture
+def fetch(app):
+    """Returns the rows of a table in the primary database as dicts."""
+    def fetch(table, *order_by):
+        with trade_log.get_engine().connect() as conn:
+            query = trade_log.select([table]).order_by(*(order_by or table.primary_key.columns))
+            return [dict(row) for row in conn.execute(query)]
+    return fetch
@@ -0,0 +1,51 @@
+from trade_log import trade_log
+
+
+def test_trades_keyset_pages(client, account_id, add_trade, add_order):
+    for (i, date) in enumerate(['2020-06-18 09:35', '2020-06-18 09:35', '2020-06-19 10:00',
+                                '2020-06-17 10:00', '2020-06-19 10:00', '2020-06-20 10:00', '2020-06-18 12:00']):
+        add_order(add_trade('T%d' % i), 'buy', 10, '10', date=date)
+    url = '/api/accounts/%d/trades' % account_id
+    everything = client.get(url).get_json()
+    assert 'next' not in everything
+    trade_ids = [t['trade_id'] for t in everything['trades']]
+    assert len(trade_ids) == 7
+
+    paged_ids = []
+    page = client.get(url + '?limit=3').get_json()
+    while True:
+        assert len(page['trades']) <= 3
+        paged_ids += [t['trade_id'] for t in page['trades']]
+        if page['next'] is None:
+            break
+        page = client.get(url + '?limit=3&after=' + page['next']).get_json()
+    assert paged_ids == trade_ids
+
+    assert client.get(url + '?after=nope').status_code == 400
+    assert client.get(url + '?limit=0').status_code == 400
+
+
+def test_stats_and_trades_answer_not_modified(client, account_id, add_trade, add_order):
+    trade_id = add_trade()
+    add_order(trade_id, 'buy', 10, '10')
+    urls = ('/api/accounts/%d/stats' % account_id, '/api/accounts/%d/trades' % account_id)
+    etags = {}
+    for url in urls:
+        response = client.get(url)
+        assert response.status_code == 200
+        etags[url] = response.headers['ETag']
+        response = client.get(url, headers={'If-None-Match': etags[url]})
+        assert response.status_code == 304
+
+    add_order(trade_id, 'sell', 10, '11')
+    for url in urls:
+        response = client.get(url, headers={'If-None-Match': etags[url]})
+        assert response.status_code == 200
+        assert response.headers['ETag'] != etags[url]
+
+
+def test_trades_json_has_the_export_columns(client, account_id, add_trade, add_order):
+    add_order(add_trade(), 'buy', 10, '10.5')
+    (trade,) = client.get('/api/accounts/%d/trades' % account_id).get_json()['trades']
+    assert set(trade) == {'account_id'} | set(trade_log.EXPORT_COLUMNS['trades'])
+    assert (trade['avg_buy_price'], trade['quantity']) == ('10.50000', 10)
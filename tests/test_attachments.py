@@ -0,0 +1,40 @@
+import io
+
+import pytest
+
+from trade_log import trade_log
+
+PNG = b'\x89PNG\r\n\x1a\n' + b'\0' * 1000
+
+
+@pytest.fixture
+def upload(client, account_id, add_trade, monkeypatch):
+    monkeypatch.setattr(trade_log, 'schedule_thumbnail', lambda digest: None)
+    trade_id = add_trade()
+
+    def upload(data, filename='a.png'):
+        response = client.post('/accounts/%d/trades/%d/attachments' % (account_id, trade_id), data={
+            'screenshot': [(io.BytesIO(data), filename)]}, content_type='multipart/form-data')
+        assert response.status_code == 302
+        return client.get(response.headers['Location']).data
+    return upload
+
+
+def test_uploads_over_the_size_limit_are_rejected(upload, fetch, monkeypatch):
+    monkeypatch.setattr(trade_log, 'ATTACHMENT_MAX_SIZE', len(PNG) - 1)
+    assert b'a.png is larger than' in upload(PNG)
+    assert fetch(trade_log.attachmentst) == []
+
+    monkeypatch.setattr(trade_log, 'ATTACHMENT_MAX_SIZE', len(PNG))
+    assert b'1 screenshot(s) attached' in upload(PNG)
+    assert len(fetch(trade_log.attachmentst)) == 1
+
+
+def test_delete_is_post_only(upload, client, account_id, fetch):
+    upload(PNG)
+    (attachment,) = fetch(trade_log.attachmentst)
+    url = '/accounts/%d/attachments/%d/delete' % (account_id, attachment['attachment_id'])
+    assert client.get(url).status_code == 405
+    assert len(fetch(trade_log.attachmentst)) == 1
+    assert client.post(url).status_code == 302
+    assert fetch(trade_log.attachmentst) == []
@@ -0,0 +1,10 @@
+from trade_log import trade_log
+
+
+def test_dashboard_lists_accounts_added_by_other_workers(client, account_id, fetch):
+    assert b'main' in client.get('/accounts').data
+    # As another worker would, without invalidating this one's cache
+    (user,) = fetch(trade_log.userst)
+    with trade_log.get_engine().begin() as conn:
+        conn.execute(trade_log.accountst.insert(), user_id=user['user_id'], name='second', cash=0)
+    assert b'second' in client.get('/accounts').data
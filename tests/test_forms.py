@@ -0,0 +1,11 @@
+def test_trades_create_form_is_empty(client, account_id):
+    response = client.get('/accounts/%d/trades/create' % account_id)
+    assert response.status_code == 200
+    assert b'None' not in response.data
+
+
+def test_orders_create_form_is_empty(client, account_id, add_trade):
+    trade_id = add_trade()
+    response = client.get('/accounts/%d/trades/%d/create' % (account_id, trade_id))
+    assert response.status_code == 200
+    assert b'None' not in response.data
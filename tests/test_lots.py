@@ -0,0 +1,72 @@
+import pytest
+
+from trade_log import trade_log
+
+
+def lots_and_fields(trade, lots):
+    return (
+        [(l['is_short'], l['quantity'], l['price']) for l in trade_log.trade_lots_values(trade.trade_id, lots)],
+        dict((k, getattr(trade, k)) for k in trade_log.TRADE_COMPUTED_FIELDS),
+    )
+
+
+def stored_and_recomputed(app, trade_id):
+    """The trade's stored open lots and computed fields, and the same
+    recomputed from all of its orders."""
+    with app.app_context():
+        trade = trade_log.db_get_where(trade_log.tradest, trade_log.tradesc.trade_id == trade_id)
+        stored = lots_and_fields(trade, trade_log.db_find_where(
+            trade_log.lotst, trade_log.lotsc.trade_id == trade_id, trade_log.lotsc.date, trade_log.lotsc.lot_id))
+        open_lots = trade_log.compute_trade_fields(trade, trade_log.load_trade_orders(trade_id))
+        return (stored, lots_and_fields(trade, open_lots))
+
+
+@pytest.mark.parametrize('orders, lots', [
+    # Long, partially closed from the oldest lot
+    ([('buy', 100, '10'), ('buy', 50, '12'), ('sell', 120, '15')], [(False, 30, 1200000)]),
+    # Short, partially covered
+    ([('sell_short', 100, '20'), ('buy_to_cover', 40, '18')], [(True, 60, 2000000)]),
+    # Closed
+    ([('buy', 100, '10'), ('sell', 60, '11'), ('sell', 40, '9')], []),
+    # Flipped through zero, the rest of the fill opens a short lot
+    ([('buy', 100, '10'), ('sell', 150, '12')], [(True, 50, 1200000)]),
+    ([('sell_short', 10, '20'), ('buy_to_cover', 30, '18'), ('sell', 5, '19')], [(False, 15, 1800000)]),
+])
+def test_appended_orders_match_a_recompute(app, add_trade, add_order, orders, lots):
+    trade_id = add_trade()
+    for (minute, (type, quantity, price)) in enumerate(orders):
+        add_order(trade_id, type, quantity, price, date='2020-06-18 10:%02d' % minute)
+    (stored, recomputed) = stored_and_recomputed(app, trade_id)
+    assert stored[0] == lots
+    assert stored == recomputed
+
+
+def test_order_inserted_before_the_last_matches_a_recompute(app, add_trade, add_order):
+    trade_id = add_trade()
+    add_order(trade_id, 'buy', 100, '10', date='2020-06-18 10:00')
+    add_order(trade_id, 'sell', 30, '12', date='2020-06-18 12:00')
+    add_order(trade_id, 'buy', 50, '11', date='2020-06-18 11:00')
+    (stored, recomputed) = stored_and_recomputed(app, trade_id)
+    assert stored[0] == [(False, 70, 1000000), (False, 50, 1100000)]
+    assert stored == recomputed
+
+
+def test_edited_and_deleted_orders_match_a_recompute(app, client, account_id, add_trade, add_order, fetch):
+    trade_id = add_trade()
+    add_order(trade_id, 'buy', 100, '10', date='2020-06-18 10:00')
+    add_order(trade_id, 'buy', 50, '12', date='2020-06-18 11:00')
+    add_order(trade_id, 'sell', 120, '15', date='2020-06-18 12:00')
+    (first, _, sell) = fetch(trade_log.orderst)
+
+    client.post('/accounts/%d/orders/%d/edit' % (account_id, first['order_id']), data=dict(
+        date='2020-06-18 10:00', type='buy', quantity='100', price='11', commission='0'))
+    (stored, recomputed) = stored_and_recomputed(app, trade_id)
+    assert stored[0] == [(False, 30, 1200000)]
+    assert stored[1]['profit'] == 100 * 400000 + 20 * 300000
+    assert stored == recomputed
+
+    client.get('/accounts/%d/orders/%d/delete' % (account_id, sell['order_id']))
+    (stored, recomputed) = stored_and_recomputed(app, trade_id)
+    assert stored[0] == [(False, 100, 1100000), (False, 50, 1200000)]
+    assert stored[1]['profit'] == 0
+    assert stored == recomputed
@@ -0,0 +1,29 @@
+from trade_log import trade_log
+
+
+def test_upgrade_schema_is_idempotent(app):
+    assert trade_log.upgrade_schema() == []
+    with trade_log.get_engine().connect() as conn:
+        assert trade_log.current_schema_version(conn) == trade_log.MIGRATIONS[-1][0]
+
+
+def test_upgrade_schema_rebuilds_rollups_and_lots(account_id, add_trade, add_order, fetch):
+    closed = add_trade('AAPL')
+    add_order(closed, 'buy', 100, '10', date='2020-06-18 09:35')
+    add_order(closed, 'sell', 100, '11', date='2020-06-19 10:00')
+    still_open = add_trade('MSFT')
+    add_order(still_open, 'buy', 50, '20')
+    add_order(still_open, 'buy', 50, '22', date='2020-06-18 11:00')
+    add_order(still_open, 'sell', 70, '25', date='2020-06-19 11:00')
+    (daily_pnl, lots) = (fetch(trade_log.daily_pnlt), fetch(trade_log.lotst))
+    assert daily_pnl and lots
+
+    # A database from before the rollup and lot migrations
+    with trade_log.get_engine().begin() as conn:
+        trade_log.daily_pnlt.drop(conn)
+        conn.execute(trade_log.lotst.delete())
+        conn.execute(trade_log.schema_versionst.delete().where(trade_log.schema_versionsc.version >= 3))
+
+    assert trade_log.upgrade_schema() == [m[0] for m in trade_log.MIGRATIONS if m[0] >= 3]
+    assert fetch(trade_log.daily_pnlt) == daily_pnl
+    assert [dict(l, lot_id=None) for l in fetch(trade_log.lotst)] == [dict(l, lot_id=None) for l in lots]
@@ -0,0 +1,36 @@
+import pytest
+
+from trade_log import trade_log
+
+
+@pytest.fixture
+def replica(app, monkeypatch, tmp_path):
+    url = 'sqlite:///%s' % (tmp_path / 'replica.db')
+    monkeypatch.setattr(trade_log, 'DATABASE_REPLICA', url)
+    monkeypatch.setattr(trade_log, '_engines', dict(trade_log._engines))
+    yield url
+    trade_log.get_engine(url).dispose()
+
+
+def test_reads_go_to_the_replica_unless_the_client_just_wrote(replica, app, client, account_id, add_trade, add_order):
+    trade_id = add_trade('AAPL')
+    add_order(trade_id, 'buy', 10, '10')
+    result = app.test_cli_runner().invoke(trade_log.sync_replica_command)
+    assert result.exit_code == 0, result.output
+    # Tells the replica's rows apart
+    with trade_log.get_engine(replica).begin() as conn:
+        conn.execute(trade_log.tradest.update().values(symbol='REPLICA'))
+    url = '/accounts/%d/trades/%d' % (account_id, trade_id)
+
+    # Sticks to the primary after writing
+    assert b'REPLICA' not in client.get(url).data
+
+    with client.session_transaction() as session:
+        session.pop('primary_until')
+    assert b'REPLICA' in client.get(url).data
+    assert b'REPLICA' in client.get('/api/accounts/%d/trades' % account_id).data
+
+    add_order(trade_id, 'sell', 10, '11')
+    assert b'REPLICA' not in client.get(url).data
+    with trade_log.get_engine(replica).connect() as conn:
+        assert conn.execute(trade_log.select([trade_log.func.count()]).select_from(trade_log.orderst)).scalar() == 1
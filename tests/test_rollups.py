@@ -0,0 +1,32 @@
+from trade_log import trade_log
+
+
+def rebuilt_daily_pnl(fetch):
+    with trade_log.get_engine().begin() as conn:
+        trade_log.rebuild_daily_pnl(conn)
+    return fetch(trade_log.daily_pnlt)
+
+
+def test_daily_pnl_follows_order_changes(client, account_id, add_trade, add_order, fetch):
+    win = add_trade('AAPL')
+    add_order(win, 'buy', 100, '10', date='2020-06-18 09:35')
+    add_order(win, 'sell', 100, '12', date='2020-06-18 15:00', commission='1')
+    loss = add_trade('MSFT')
+    add_order(loss, 'sell_short', 10, '20', date='2020-06-18 10:00')
+    add_order(loss, 'buy_to_cover', 10, '21', date='2020-06-19 10:00')
+    daily_pnl = fetch(trade_log.daily_pnlt)
+    assert [(d['date'].day, d['trade_count'], d['win_count'], d['loss_count']) for d in daily_pnl] == [
+        (18, 1, 1, 0), (19, 1, 0, 1)]
+    assert daily_pnl == rebuilt_daily_pnl(fetch)
+
+    # Moves the loss to the day of the win
+    cover = fetch(trade_log.orderst)[-1]
+    client.post('/accounts/%d/orders/%d/edit' % (account_id, cover['order_id']), data=dict(
+        date='2020-06-18 11:00', type='buy_to_cover', quantity='10', price='21', commission='0'))
+    daily_pnl = fetch(trade_log.daily_pnlt)
+    assert [(d['date'].day, d['trade_count']) for d in daily_pnl] == [(18, 2)]
+    assert daily_pnl == rebuilt_daily_pnl(fetch)
+
+    client.get('/accounts/%d/orders/%d/delete' % (account_id, cover['order_id']))
+    daily_pnl = fetch(trade_log.daily_pnlt)
+    assert daily_pnl == rebuilt_daily_pnl(fetch)
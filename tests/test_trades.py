@@ -0,0 +1,19 @@
+import logging
+
+from trade_log import trade_log
+
+
+def test_recompute_finds_no_drift_in_rounded_averages(app, add_trade, add_order, fetch, caplog):
+    trade_id = add_trade()
+    add_order(trade_id, 'buy', 1, '10.00001')
+    add_order(trade_id, 'buy', 1, '10.00002')
+    add_order(trade_id, 'sell', 2, '11.00001')
+    add_order(trade_id, 'sell', 1, '11.00002')
+    (trade,) = fetch(trade_log.tradest)
+    assert (trade['avg_buy_price'], trade['avg_sell_price']) == (1000002, 1100002)
+
+    with caplog.at_level(logging.INFO, logger=app.logger.name):
+        result = app.test_cli_runner().invoke(trade_log.recompute_trades_command, ['--check'])
+    assert result.exit_code == 0, result.output
+    assert 'drifted from its orders' not in caplog.text
+    assert '0 trade(s) drifted' in caplog.text
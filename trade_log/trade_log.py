@@ -1,17 +1,50 @@
+import io
 import os
+import re
+import csv
+import gzip
+import json
+import click
+import codecs
+import random
+import mimetypes
+import threading
+import tracemalloc
+import subprocess
+import sys
 import pytz
 import decimal
-from datetime import datetime, timedelta
-from hashlib import md5
+import tempfile
+from datetime import datetime, time, timedelta
+from hashlib import md5, sha256
 from functools import wraps
 from datetime import datetime
-from collections import namedtuple
-from flask import Flask, request, session, url_for, redirect, \
-    render_template, abort, g, flash, _app_ctx_stack, abort
+from collections import namedtuple, OrderedDict, deque
+from time import monotonic, perf_counter
+from concurrent.futures import ProcessPoolExecutor
+from markupsafe import Markup
+import flask
+import jinja2
+import numpy as np
+try:
+    from PIL import Image
+except ImportError:
+    # Attachments are served without thumbnails
+    Image = None
+try:
+    import rcssmin
+    import rjsmin
+except ImportError:
+    # Assets are built without being minified
+    rcssmin = rjsmin = None
+from flask import Flask, Response, request, session, url_for, redirect, \
+    abort, g, flash, _app_ctx_stack, abort, has_request_context, jsonify, send_file
 from werkzeug import check_password_hash, generate_password_hash
 
-from sqlalchemy import create_engine, select, MetaData, Table, Column, \
-    BigInteger, Integer, Text, DateTime, Boolean, ForeignKey
+from sqlalchemy import create_engine, event, exc, select, MetaData, Table, Column, \
+    BigInteger, Integer, Text, Date, DateTime, Boolean, ForeignKey, Index, and_, \
+    or_, case, func, inspect, true, text, DDL
+from sqlalchemy.sql.expression import SelectBase
 
 
 # Config
@@ -25,16 +58,59 @@ LOCAL_DATABASE_URL = 'sqlite:///trade_log.db'
 DATABASE = os.getenv('DATABASE_URL', LOCAL_DATABASE_URL)
 DEBUG = True if os.getenv('DEBUG', '0') == '1' else False
 SECRET_KEY = os.getenv('SECRET_KEY', 'keyboard cat')
+# Postgres connection pool
+DATABASE_POOL_SIZE = int(os.getenv('DATABASE_POOL_SIZE', '5'))
+DATABASE_MAX_OVERFLOW = int(os.getenv('DATABASE_MAX_OVERFLOW', '10'))
+DATABASE_POOL_RECYCLE = int(os.getenv('DATABASE_POOL_RECYCLE', '1800'))
+DATABASE_POOL_PRE_PING = os.getenv('DATABASE_POOL_PRE_PING', '1') == '1'
+# SQLite
+SQLITE_JOURNAL_MODE = os.getenv('SQLITE_JOURNAL_MODE', 'WAL')
+SQLITE_SYNCHRONOUS = os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL')
+SQLITE_BUSY_TIMEOUT = int(os.getenv('SQLITE_BUSY_TIMEOUT', '5000'))
+SQLITE_MMAP_SIZE = int(os.getenv('SQLITE_MMAP_SIZE', str(256 * 1024 * 1024)))
+# Read-only queries of GET requests go to this replica when set
+DATABASE_REPLICA = os.getenv('DATABASE_REPLICA_URL', '')
+# Seconds a client reads from the primary after a write, to cover the
+# replication lag
+DATABASE_REPLICA_STICKY = int(os.getenv('DATABASE_REPLICA_STICKY', '10'))
+PROFILING = os.getenv('PROFILING', '0') == '1'
+# `memory`, `filesystem` (shared by the workers of a host) or `none`
+FRAGMENT_CACHE = os.getenv('FRAGMENT_CACHE', 'memory')
+FRAGMENT_CACHE_DIR = os.getenv('FRAGMENT_CACHE_DIR', '/tmp/trade_log_fragments')
+FRAGMENT_CACHE_BYTES = int(os.getenv('FRAGMENT_CACHE_BYTES', str(64 * 1024 * 1024)))
+CACHE_TTL = float(os.getenv('CACHE_TTL', '60'))
+CACHE_SIZE = int(os.getenv('CACHE_SIZE', '1024'))
+# `file` (QUOTES_FILE CSV), `sqlite` (QUOTES_DATABASE_URL) or `none`
+QUOTE_PROVIDER = os.getenv('QUOTE_PROVIDER', 'file')
+QUOTES_FILE = os.getenv('QUOTES_FILE', 'quotes.csv')
+QUOTES_DATABASE_URL = os.getenv('QUOTES_DATABASE_URL', 'sqlite:///quotes.db')
+QUOTE_TTL = float(os.getenv('QUOTE_TTL', '60'))
+ATTACHMENTS_DIR = os.path.abspath(os.getenv('ATTACHMENTS_DIR', 'attachments'))
+ATTACHMENT_MAX_SIZE = int(os.getenv('ATTACHMENT_MAX_SIZE', str(10 * 1024 * 1024)))
+# Larger request bodies, uploads included, are answered 413
+MAX_CONTENT_LENGTH = int(os.getenv('MAX_CONTENT_LENGTH', str(64 * 1024 * 1024)))
+THUMBNAIL_SIZE = int(os.getenv('THUMBNAIL_SIZE', '320'))
+THUMBNAIL_WORKERS = int(os.getenv('THUMBNAIL_WORKERS', '2'))
+# Compiled template bytecode shared by the workers, fill it at build time
+# with `flask compile-templates`, empty to compile in every process
+TEMPLATE_CACHE_DIR = os.getenv('TEMPLATE_CACHE_DIR', '')
 
 NEW_YORK_TZ = pytz.timezone('America/New_York')
 
 ORDER_TYPES = ('buy', 'sell', 'sell_short', 'buy_to_cover',)
+ORDER_FIELDS = ('date', 'type', 'quantity', 'price', 'commission',)
+ORDERS_BATCH_ROWS = 10
+ORDERS_BATCH_MAX = 1000
+TRADE_FILTERS = ('symbol', 'side', 'start', 'end', 'result',)
+TRADE_SIDES = ('long', 'short',)
+TRADE_RESULTS = ('win', 'loss',)
+BUY_ORDER_TYPES = ('buy', 'buy_to_cover',)
+SHORT_ORDER_TYPES = ('sell_short', 'buy_to_cover',)
+OPENING_ORDER_TYPES = ('buy', 'sell_short',)
 
 app = Flask('trade_log')
 app.config.from_object(__name__)
 
-engine = create_engine(DATABASE, echo=DEBUG)
-
 
 # Tables
 # ######################################
@@ -56,6 +132,8 @@ accounts = Table(
     Column('user_id', Integer, ForeignKey('user.user_id'), nullable=False),
     Column('name', Text, nullable=False),
     Column('cash', BigInteger, nullable=False),
+    # Bumped on every trade/order write, used as ETag
+    Column('version', BigInteger, nullable=False, server_default='0'),
 )
 accountst = accounts
 accountsc = accounts.c
@@ -83,6 +161,13 @@ trades = Table(
     Column('quantity', Integer, nullable=False),
     Column('quantity_outstanding', Integer, nullable=False),
     Column('orders_count', Integer, nullable=False),
+    # Running totals behind the averages, for incremental updates
+    Column('buy_count', Integer, nullable=False, server_default='0'),
+    Column('buy_price_total', BigInteger, nullable=False, server_default='0'),
+    Column('sell_count', Integer, nullable=False, server_default='0'),
+    Column('sell_price_total', BigInteger, nullable=False, server_default='0'),
+    # Entry value of the open lots
+    Column('cost_basis', BigInteger, nullable=False, server_default='0'),
 )
 tradest = trades
 tradesc = trades.c
@@ -101,6 +186,244 @@ orders = Table(
 orderst = orders
 ordersc = orders.c
 
+lots = Table(
+    'lot', metadata,
+    Column('lot_id', Integer, primary_key=True),
+    Column('trade_id', Integer, ForeignKey('trade.trade_id'), nullable=False),
+    # Order that opened the lot, not a foreign key as orders get deleted
+    # before their trade's lots are rebuilt
+    Column('order_id', Integer),
+    Column('date', DateTime, nullable=False),
+    Column('is_short', Boolean, nullable=False),
+    # Still open
+    Column('quantity', BigInteger, nullable=False),
+    Column('price', BigInteger, nullable=False),
+)
+lotst = lots
+lotsc = lots.c
+
+attachments = Table(
+    'attachment', metadata,
+    Column('attachment_id', Integer, primary_key=True),
+    Column('trade_id', Integer, ForeignKey('trade.trade_id'), nullable=False),
+    # Hex SHA-256 of the content, its file name in ATTACHMENTS_DIR
+    Column('sha256', Text, nullable=False),
+    Column('filename', Text, nullable=False),
+    Column('content_type', Text, nullable=False),
+    Column('size', BigInteger, nullable=False),
+    Column('created_at', DateTime, nullable=False),
+)
+attachmentst = attachments
+attachmentsc = attachments.c
+
+daily_pnl = Table(
+    'daily_pnl', metadata,
+    Column('account_id', Integer, ForeignKey('account.account_id'), primary_key=True),
+    Column('date', Date, primary_key=True),
+    # Rollup of the trades whose last order is on that day
+    Column('trade_count', Integer, nullable=False),
+    Column('profit', BigInteger, nullable=False),
+    Column('commissions', BigInteger, nullable=False),
+    Column('win_count', Integer, nullable=False),
+    Column('loss_count', Integer, nullable=False),
+    Column('win_total', BigInteger, nullable=False),
+    Column('loss_total', BigInteger, nullable=False),
+    Column('largest_win', BigInteger),
+    Column('largest_loss', BigInteger),
+)
+daily_pnlt = daily_pnl
+daily_pnlc = daily_pnl.c
+
+schema_versions = Table(
+    'schema_version', metadata,
+    Column('version', Integer, primary_key=True),
+    Column('description', Text, nullable=False),
+    Column('applied_at', DateTime, nullable=False),
+)
+schema_versionst = schema_versions
+schema_versionsc = schema_versions.c
+
+# Indexes
+user_email_idx = Index('user_email_idx', usersc.email)
+user_username_idx = Index('user_username_idx', usersc.username)
+account_user_id_idx = Index('account_user_id_idx', accountsc.user_id)
+trade_account_id_last_order_date_idx = Index(
+    'trade_account_id_last_order_date_idx',
+    tradesc.account_id, tradesc.last_order_date.desc(), tradesc.trade_id.desc(),
+)
+order_trade_id_date_idx = Index('order_trade_id_date_idx', ordersc.trade_id, ordersc.date)
+order_account_id_idx = Index('order_account_id_idx', ordersc.account_id)
+trade_account_id_symbol_idx = Index(
+    'trade_account_id_symbol_idx',
+    tradesc.account_id, tradesc.symbol, tradesc.last_order_date,
+)
+attachment_trade_id_idx = Index('attachment_trade_id_idx', attachmentsc.trade_id)
+attachment_sha256_idx = Index('attachment_sha256_idx', attachmentsc.sha256)
+lot_trade_id_date_idx = Index('lot_trade_id_date_idx', lotsc.trade_id, lotsc.date, lotsc.lot_id)
+
+
+# Migrations
+# ######################################
+
+MIGRATIONS = []
+
+
+def migration(version, description):
+    """Registers a schema upgrade step. Steps run in version order inside
+    their own transaction and must be safe to run against a database
+    freshly created by `metadata.create_all`."""
+    def decorator(func):
+        MIGRATIONS.append((version, description, func))
+        MIGRATIONS.sort(key=lambda m: m[0])
+        return func
+    return decorator
+
+
+def create_index_if_missing(conn, index):
+    existing = [i['name'] for i in inspect(conn).get_indexes(index.table.name)]
+    if index.name not in existing:
+        index.create(conn)
+
+
+def recreate_index_if_changed(conn, index):
+    """Recreates an index whose columns changed since it was created."""
+    existing = dict((i['name'], i['column_names']) for i in inspect(conn).get_indexes(index.table.name))
+    if existing.get(index.name) == [c.name for c in index.columns]:
+        return
+    if index.name in existing:
+        index.drop(conn)
+    index.create(conn)
+
+
+def add_column_if_missing(conn, table, column):
+    existing = [c['name'] for c in inspect(conn).get_columns(table.name)]
+    if column.name in existing:
+        return
+    quote = conn.dialect.identifier_preparer.quote
+    ddl = 'ALTER TABLE %s ADD COLUMN %s %s' % (
+        quote(table.name), quote(column.name), column.type.compile(dialect=conn.dialect))
+    if column.server_default is not None:
+        ddl += ' DEFAULT %s' % column.server_default.arg
+    if not column.nullable:
+        ddl += ' NOT NULL'
+    conn.execute(ddl)
+
+
+def current_schema_version(conn):
+    result = conn.execute(select([func.max(schema_versionsc.version)]))
+    version = result.scalar()
+    result.close()
+    return version or 0
+
+
+def upgrade_schema():
+    """Applies every pending migration and returns the versions applied."""
+    schema_versionst.create(get_engine(), checkfirst=True)
+    applied = []
+    for (version, description, upgrade) in MIGRATIONS:
+        with get_engine().begin() as conn:
+            if version <= current_schema_version(conn):
+                continue
+            upgrade(conn)
+            conn.execute(
+                schema_versionst.insert(),
+                version=version,
+                description=description,
+                applied_at=datetime.utcnow(),
+            )
+        applied.append(version)
+    return applied
+
+
+@migration(1, 'Add indexes for user, account, trade and order lookups')
+def migration_lookup_indexes(conn):
+    for index in (
+        user_email_idx,
+        user_username_idx,
+        account_user_id_idx,
+        trade_account_id_last_order_date_idx,
+        order_trade_id_date_idx,
+        order_account_id_idx,
+    ):
+        create_index_if_missing(conn, index)
+
+
+@migration(2, 'Add trade buy/sell price running totals')
+def migration_trade_price_totals(conn):
+    for name in ('buy_count', 'buy_price_total', 'sell_count', 'sell_price_total'):
+        add_column_if_missing(conn, tradest, tradesc[name])
+
+    def order_totals(aggregate, types):
+        return select([func.coalesce(aggregate, 0)]).where(and_(
+            ordersc.trade_id == tradesc.trade_id,
+            ordersc.type.in_(types),
+        )).as_scalar()
+
+    sell_types = [t for t in ORDER_TYPES if t not in BUY_ORDER_TYPES]
+    conn.execute(tradest.update().values(
+        buy_count=order_totals(func.count(ordersc.order_id), BUY_ORDER_TYPES),
+        buy_price_total=order_totals(func.sum(ordersc.price), BUY_ORDER_TYPES),
+        sell_count=order_totals(func.count(ordersc.order_id), sell_types),
+        sell_price_total=order_totals(func.sum(ordersc.price), sell_types),
+    ))
+
+
+@migration(3, 'Add daily_pnl rollup table')
+def migration_daily_pnl(conn):
+    daily_pnlt.create(conn, checkfirst=True)
+    rebuild_daily_pnl(conn)
+
+
+@migration(4, 'Add account change version')
+def migration_account_version(conn):
+    add_column_if_missing(conn, accountst, accountsc.version)
+
+
+@migration(5, 'Add FIFO lots and trade cost basis')
+def migration_lots(conn):
+    lotst.create(conn, checkfirst=True)
+    create_index_if_missing(conn, lot_trade_id_date_idx)
+    add_column_if_missing(conn, tradest, tradesc.cost_basis)
+
+    # Profit of open trades is now the realized P&L of matched lots
+    open_trades = conn.execute(select([tradest]).where(tradesc.quantity_outstanding != 0)).fetchall()
+    for row in open_trades:
+        trade = TradeRow.from_row(row)
+        orders = conn.execute(
+            select([orderst]).where(ordersc.trade_id == trade.trade_id)
+            .order_by(ordersc.date, ordersc.order_id)
+        ).fetchall()
+        open_lots = compute_trade_fields(trade, [OrderRow.from_row(o) for o in orders])
+        conn.execute(trade_computed_fields_update(trade))
+        conn.execute(lotst.delete().where(lotsc.trade_id == trade.trade_id))
+        if open_lots:
+            conn.execute(lotst.insert(), trade_lots_values(trade.trade_id, open_lots))
+    rebuild_daily_pnl(conn)
+
+
+@migration(6, 'Add trade symbol index and normalize symbols')
+def migration_trade_symbol(conn):
+    # Symbols are matched with = to use the index
+    conn.execute(tradest.update().values(symbol=func.upper(func.trim(tradesc.symbol))))
+    create_index_if_missing(conn, trade_account_id_symbol_idx)
+
+
+@migration(7, 'Add trade screenshot attachments')
+def migration_attachments(conn):
+    attachmentst.create(conn, checkfirst=True)
+    create_index_if_missing(conn, attachment_trade_id_idx)
+    create_index_if_missing(conn, attachment_sha256_idx)
+
+
+@migration(8, 'Add trade journal full-text search index')
+def migration_trade_search(conn):
+    rebuild_trade_search(conn)
+
+
+@migration(9, 'Add trade_id to the trade list index for keyset pagination')
+def migration_trade_list_index(conn):
+    recreate_index_if_changed(conn, trade_account_id_last_order_date_idx)
+
 
 # Commands
 # ######################################
@@ -108,15 +431,29 @@ ordersc = orders.c
 @app.cli.command('initdb')
 def initdb_command():
     """Creates the database tables."""
-    metadata.create_all(engine, checkfirst=True)
+    metadata.create_all(get_engine(), checkfirst=True)
+    upgrade_schema()
     app.logger.info('database initialized')
 
 
+@app.cli.command('migrate')
+def migrate_command():
+    """Upgrades an existing database to the latest schema version."""
+    applied = upgrade_schema()
+    with get_engine().connect() as conn:
+        version = current_schema_version(conn)
+    if applied:
+        app.logger.info('applied migrations %s, now at version %d', applied, version)
+    else:
+        app.logger.info('database already at version %d', version)
+
+
 @app.cli.command('resetdb')
 def resetdb_command():
     """Drop and creates all tables"""
-    metadata.drop_all(engine)
-    metadata.create_all(engine)
+    metadata.drop_all(get_engine())
+    metadata.create_all(get_engine())
+    upgrade_schema()
     db_exec(
         userst.insert(),
         username='test',
@@ -126,21 +463,444 @@ def resetdb_command():
     app.logger.info('database reset')
 
 
+@app.cli.command('sync-replica')
+def sync_replica_command():
+    """Copies the SQLite primary into the SQLite replica, to try read
+    routing locally."""
+    if not DATABASE_REPLICA:
+        raise click.ClickException('DATABASE_REPLICA_URL is not set')
+    (primary, replica) = (get_engine(), get_engine(DATABASE_REPLICA))
+    if primary.dialect.name != 'sqlite' or replica.dialect.name != 'sqlite':
+        raise click.ClickException('only SQLite databases can be synced')
+    source = primary.raw_connection()
+    target = replica.raw_connection()
+    try:
+        source.connection.backup(target.connection)
+    finally:
+        target.close()
+        source.close()
+    app.logger.info('replica synced')
+
+
+@app.cli.command('rebuild-rollups')
+def rebuild_rollups_command():
+    """Regenerates the daily_pnl rollup table from the trades."""
+    with get_engine().begin() as conn:
+        rebuild_daily_pnl(conn)
+    app.logger.info('rollups rebuilt')
+
+
+@app.cli.command('rebuild-search')
+def rebuild_search_command():
+    """Regenerates the trade journal full-text search index."""
+    with get_engine().begin() as conn:
+        rebuild_trade_search(conn)
+    app.logger.info('search index rebuilt')
+
+
+@app.cli.command('import-orders')
+@click.argument('account_id', type=int)
+@click.argument('statement', type=click.File('r', encoding='utf-8-sig'))
+def import_orders_command(account_id, statement):
+    """Imports a CSV broker statement of orders into an account."""
+    if db_get_where(accountst, accountsc.account_id == account_id) is None:
+        raise click.ClickException('account #%d does not exist' % account_id)
+    summary = import_orders(account_id, statement)
+    for (line, error) in summary.errors:
+        click.echo('line %d: %s' % (line, error), err=True)
+    click.echo('imported %d order(s) into %d trade(s)' % (summary.orders_count, summary.trades_count))
+
+
+@app.cli.command('import-quotes')
+@click.argument('quotes_file', type=click.File('r', encoding='utf-8-sig'))
+def import_quotes_command(quotes_file):
+    """Loads a `symbol,price[,date]` CSV into the SQLite quote store."""
+    quotes = read_quotes_csv(quotes_file)
+    DatabaseQuoteProvider(QUOTES_DATABASE_URL).set_quotes(quotes.values())
+    click.echo('imported %d quote(s)' % len(quotes))
+
+
+@app.cli.command('export')
+@click.argument('account_id', type=int)
+@click.argument('kind', type=click.Choice(['trades', 'orders']))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'json']), default='csv')
+@click.option('--start', help='YYYY-MM-DD[ HH:MM]')
+@click.option('--end', help='YYYY-MM-DD[ HH:MM]')
+@click.option('--symbol')
+@click.option('--output', type=click.File('w'), default='-')
+def export_command(account_id, kind, fmt, start, end, symbol, output):
+    """Streams an account's trades or orders as CSV or JSON."""
+    start_date = parse_date_bound(start) if start else None
+    end_date = parse_date_bound(end, end=True) if end else None
+    if (start and start_date is None) or (end and end_date is None):
+        raise click.BadParameter('dates must be YYYY-MM-DD or YYYY-MM-DD HH:MM')
+    query = export_query(kind, account_id, start_date, end_date, symbol)
+    for chunk in export_rows(kind, query, fmt):
+        output.write(chunk)
+
+
+@app.cli.command('seed-bench')
+@click.option('--users', default=1, help='Users to create.')
+@click.option('--accounts', default=1, help='Accounts per user.')
+@click.option('--trades', default=1000, help='Trades per account.')
+@click.option('--max-fills', default=6, help='Max entry (and exit) fills per trade.')
+@click.option('--seed', default=1)
+def seed_bench_command(users, accounts, trades, max_fills, seed):
+    """Generates benchmark users, accounts, trades and orders."""
+    rng = random.Random(seed)
+    for _ in range(users):
+        user_id = seed_bench_user(rng, accounts, trades, max_fills)
+        click.echo('created user #%d' % user_id)
+    with get_engine().begin() as conn:
+        rebuild_daily_pnl(conn)
+
+
+@app.cli.command('bench')
+@click.option('--account-id', type=int, help='Defaults to the largest account.')
+@click.option('--requests', 'count', default=50, help='Iterations per scenario.')
+@click.option('--output', type=click.File('w'), help='Write the results as JSON.')
+@click.option('--baseline', type=click.File('r'), help='Results JSON to compare against.')
+def bench_command(account_id, count, output, baseline):
+    """Benchmarks the hot request paths against the current database."""
+    if account_id is None:
+        result = db_exec(
+            select([tradesc.account_id]).group_by(tradesc.account_id)
+            .order_by(func.count().desc()).limit(1)
+        )
+        account_id = result.scalar()
+        result.close()
+    if account_id is None:
+        raise click.ClickException('no trades to benchmark, run seed-bench first')
+
+    results = run_bench(account_id, count)
+    previous = json.load(baseline)['scenarios'] if baseline else {}
+    for (name, stats) in sorted(results['scenarios'].items()):
+        line = '%-30s p50 %8.2fms  p95 %8.2fms  p99 %8.2fms  %6.1f queries  %8d KiB peak' % (
+            name, stats['p50_ms'], stats['p95_ms'], stats['p99_ms'],
+            stats['queries'], stats['peak_memory_kib'])
+        if name in previous and previous[name]['p50_ms']:
+            line += '  p50 %+.0f%%' % ((stats['p50_ms'] / previous[name]['p50_ms'] - 1) * 100)
+        click.echo(line)
+    if output:
+        json.dump(results, output, indent=2, sort_keys=True)
+
+
+@app.cli.command('compile-templates')
+def compile_templates_command():
+    """Compiles every template into TEMPLATE_CACHE_DIR."""
+    if not TEMPLATE_CACHE_DIR:
+        raise click.ClickException('TEMPLATE_CACHE_DIR is not set')
+    app.jinja_env.bytecode_cache.clear()
+    click.echo('compiled %d template(s)' % load_templates())
+
+
+@app.cli.command('build-assets')
+def build_assets_command():
+    """Builds the fingerprinted static assets into ASSETS_DIR."""
+    manifest = build_assets()
+    if rjsmin is None:
+        click.echo('rjsmin/rcssmin not installed, assets were not minified')
+    for (name, built) in sorted(manifest.items()):
+        click.echo('%s -> %s' % (name, built))
+
+
+@app.cli.command('startup-time')
+@click.option('--runs', default=5, help='Fresh processes to start.')
+@click.option('--path', default='/', help='URL of the first request.')
+def startup_time_command(runs, path):
+    """Measures how long a fresh worker process takes from import to its
+    first response."""
+    results = [measure_startup(path) for _ in range(runs)]
+    for name in STARTUP_PHASES:
+        timings = sorted(r[name] for r in results)
+        click.echo('%-16s p50 %8.2fms  max %8.2fms' % (name, percentile(timings, 50), timings[-1]))
+
+
+@app.cli.command('recompute-trades')
+@click.option('--check', is_flag=True, help='Only report drifted trades.')
+def recompute_trades_command(check):
+    """Recomputes every trade's computed fields from its orders, repairing
+    any drift left by incremental updates."""
+    drifted = 0
+    for trade in db_find_where(tradest, tradesc.trade_id.isnot(None)):
+        with get_db().begin():
+            if not check:
+                # So no order is written between the check and the repair
+                trade = lock_trade(tradesc.trade_id == trade.trade_id)
+            orders = load_trade_orders(trade.trade_id)
+            if not orders:
+                continue
+            stored = dict((k, getattr(trade, k)) for k in TRADE_COMPUTED_FIELDS)
+            stored_lots = trade_lots_values(trade.trade_id, db_find_where(
+                lotst, lotsc.trade_id == trade.trade_id, lotsc.date, lotsc.lot_id))
+            open_lots = compute_trade_fields(trade, orders)
+            if any(stored[k] != getattr(trade, k) for k in TRADE_COMPUTED_FIELDS) or \
+                    stored_lots != trade_lots_values(trade.trade_id, open_lots):
+                drifted += 1
+                app.logger.warning('trade #%d drifted from its orders', trade.trade_id)
+                if not check:
+                    save_trade_computed_fields(trade)
+                    save_trade_lots(trade.trade_id, open_lots)
+    app.logger.info('%d trade(s) drifted', drifted)
+
+
 # Utils
 # ######################################
 
-class Entity:
+class Row:
+    """Base of the compact, slotted records rows are loaded into. Unset
+    columns default to None so placeholder rows can be built for forms."""
+    __slots__ = ()
+
     def __init__(self, **kwargs):
-        self.__dict__ = kwargs
+        for name in self.__slots__:
+            setattr(self, name, kwargs.pop(name, None))
+        if kwargs:
+            raise TypeError('unknown columns: %s' % ', '.join(kwargs))
+
+    def __repr__(self):
+        return '<%s #%r>' % (type(self).__name__, getattr(self, self.__slots__[0]))
+
+    @classmethod
+    def from_row(cls, row):
+        """Builds the record from a `select([table])` row, columns in order."""
+        obj = cls.__new__(cls)
+        for (name, value) in zip(cls.__slots__, row):
+            setattr(obj, name, value)
+        return obj
+
+
+row_classes = {}
+
+
+def row_class(table):
+    """Returns the Row subclass, with one slot per column, for a table."""
+    cls = row_classes.get(table)
+    if cls is None:
+        name = ''.join(part.capitalize() for part in table.name.split('_')) + 'Row'
+        cls = type(name, (Row,), {'__slots__': tuple(c.name for c in table.columns)})
+        row_classes[table] = cls
+    return cls
+
+
+UserRow = row_class(users)
+AccountRow = row_class(accounts)
+TradeRow = row_class(trades)
+OrderRow = row_class(orders)
+LotRow = row_class(lots)
+AttachmentRow = row_class(attachments)
+
+
+class LRUCache:
+    """Thread-safe, size bounded LRU cache whose entries expire `ttl`
+    seconds after being set. Counts hits and misses."""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the cached value or None."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return None
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def stats(self):
+        with self.lock:
+            return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses}
+
+
+class MemoryFragmentStore:
+    """In process store of rendered fragments, evicting the least recently
+    used ones past `max_bytes` of text."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self._pop(key)
+            self.entries[key] = value
+            self.size += len(value)
+            while self.size > self.max_bytes and self.entries:
+                self._pop(next(iter(self.entries)))
+
+    def delete_prefix(self, prefix):
+        with self.lock:
+            for key in [k for k in self.entries if k.startswith(prefix)]:
+                self._pop(key)
+
+    def _pop(self, key):
+        value = self.entries.pop(key, None)
+        if value is not None:
+            self.size -= len(value)
+
+
+class FilesystemFragmentStore:
+    """Stores rendered fragments as files in `path` so every worker of the
+    host shares them. Writes are atomic renames.
+
+    Files are grouped in a directory per the first two parts of their key
+    (e.g. `account-12`), so deleting a prefix at least that long only
+    lists that group's few files instead of the whole cache."""
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def group_dir(self, key):
+        return os.path.join(self.path, '-'.join(key.split('-', 2)[:2]))
+
+    def get(self, key):
+        try:
+            with open(os.path.join(self.group_dir(key), key), encoding='utf-8') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def set(self, key, value):
+        path = self.group_dir(key)
+        os.makedirs(path, exist_ok=True)
+        tmp = os.path.join(path, '.%s.%d' % (key, os.getpid()))
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write(value)
+        os.replace(tmp, os.path.join(path, key))
+
+    def delete_prefix(self, prefix):
+        if prefix.count('-') >= 2:
+            paths = [self.group_dir(prefix)]
+        else:
+            paths = [os.path.join(self.path, name) for name in os.listdir(self.path)]
+        for path in paths:
+            try:
+                names = os.listdir(path)
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            for name in names:
+                if name.startswith(prefix):
+                    try:
+                        os.remove(os.path.join(path, name))
+                    except FileNotFoundError:
+                        pass
+
+
+class NullFragmentStore:
+    def get(self, key):
+        return None
+
+    def set(self, key, value):
+        pass
 
+    def delete_prefix(self, prefix):
+        pass
 
-def objectify(row):
+
+def objectify(row, cls):
     if row is None:
         return None
-    obj = {}
-    for (key, value) in row.items():
-        obj[key] = value
-    return Entity(**obj)
+    return cls.from_row(row)
+
+
+def parse_order_fields(fields):
+    """Parses an order's date/type/quantity/price/commission text fields
+    with the order form rules, returns (values, error message)."""
+    date = parse_datetime(fields.get('date') or '')
+    quantity = parse_int(fields.get('quantity') or '')
+    price = parse_decimal_to_bigint(fields.get('price') or '')
+    commission = parse_decimal_to_bigint(fields.get('commission') or '')
+
+    if date is None:
+        return (None, 'A valid date is required')
+    elif fields.get('type') not in ORDER_TYPES:
+        return (None, 'No hax plz')
+    elif quantity is None:
+        return (None, 'Quantity entered is not a number')
+    elif price is None:
+        return (None, 'Price entered is not a number')
+    elif commission is None:
+        return (None, 'Commission entered is not a number')
+    return (dict(
+        date=date,
+        type=fields['type'],
+        quantity=quantity,
+        price=price,
+        commission=commission,
+    ), None)
+
+
+def parse_orders_batch(rows):
+    """Parses a batch of order field dicts with parse_order_fields, returns
+    (orders, errors) where errors are (row number, message) pairs. Nothing
+    should be saved unless errors is empty."""
+    orders = []
+    errors = []
+    if not rows:
+        errors.append((0, 'At least one order is required'))
+    elif len(rows) > ORDERS_BATCH_MAX:
+        errors.append((0, 'At most %d orders can be added at once' % ORDERS_BATCH_MAX))
+    else:
+        for (i, fields) in enumerate(rows, 1):
+            (order, error) = parse_order_fields(fields)
+            if error is not None:
+                errors.append((i, error))
+            else:
+                orders.append(order)
+    return (orders, errors)
+
+
+def parse_trade_filters(args):
+    """Parses the TRADE_FILTERS trade list query arguments, returns
+    (filters, error message). Empty arguments don't filter."""
+    filters = {}
+    symbol = (args.get('symbol') or '').strip().upper()
+    if symbol:
+        filters['symbol'] = symbol
+    for (name, choices) in (('side', TRADE_SIDES), ('result', TRADE_RESULTS)):
+        value = args.get(name) or ''
+        if value and value not in choices:
+            return (None, 'No hax plz')
+        elif value:
+            filters[name] = value
+    for name in ('start', 'end'):
+        if not args.get(name):
+            continue
+        date = parse_date_bound(args[name].strip(), end=name == 'end')
+        if date is None:
+            return (None, 'The %s date must be YYYY-MM-DD' % name)
+        filters[name] = date
+    return (filters, None)
 
 
 def parse_decimal_to_bigint(text):
@@ -166,6 +926,25 @@ def parse_datetime(text):
         return None
 
 
+def parse_date_bound(text, end=False):
+    """Parses a `YYYY-MM-DD` or `YYYY-MM-DD HH:MM` range bound, a date only
+    end bound covers the whole day."""
+    date = parse_datetime(text)
+    if date is None:
+        try:
+            date = datetime.strptime(text, '%Y-%m-%d')
+        except ValueError:
+            return None
+        if end:
+            date += timedelta(days=1, microseconds=-1)
+    return date
+
+
+def format_decimal(bignum):
+    """Format a $ bigint as an exact decimal string, for exports."""
+    return str(decimal.Decimal(int(round(bignum))).scaleb(-5))
+
+
 def format_number(bignum):
     """Format a $ bigint for display."""
     if bignum is None:
@@ -189,31 +968,186 @@ def gravatar_url(email, size=80):
 app.jinja_env.filters['format_number'] = format_number
 app.jinja_env.filters['format_datetime'] = format_datetime
 app.jinja_env.filters['gravatar'] = gravatar_url
+if TEMPLATE_CACHE_DIR:
+    os.makedirs(TEMPLATE_CACHE_DIR, exist_ok=True)
+    app.jinja_env.bytecode_cache = jinja2.FileSystemBytecodeCache(TEMPLATE_CACHE_DIR)
 
 
 # Database
 # ######################################
 
+_engines = {}
+_engine_lock = threading.Lock()
+
+
+def create_app_engine(url):
+    """Creates an engine configured from the DATABASE_* / SQLITE_* settings."""
+    if url.startswith('sqlite'):
+        engine = create_engine(url, echo=DEBUG)
+
+        @event.listens_for(engine, 'connect')
+        def set_sqlite_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            cursor.execute('PRAGMA journal_mode=%s' % SQLITE_JOURNAL_MODE)
+            cursor.execute('PRAGMA synchronous=%s' % SQLITE_SYNCHRONOUS)
+            cursor.execute('PRAGMA busy_timeout=%d' % SQLITE_BUSY_TIMEOUT)
+            cursor.execute('PRAGMA mmap_size=%d' % SQLITE_MMAP_SIZE)
+            cursor.close()
+    else:
+        engine = create_engine(
+            url,
+            echo=DEBUG,
+            pool_size=DATABASE_POOL_SIZE,
+            max_overflow=DATABASE_MAX_OVERFLOW,
+            pool_recycle=DATABASE_POOL_RECYCLE,
+        )
+        if DATABASE_POOL_PRE_PING:
+            event.listen(engine, 'engine_connect', ping_connection)
+
+    if PROFILING:
+        event.listen(engine, 'before_cursor_execute', profile_query_start)
+        event.listen(engine, 'after_cursor_execute', profile_query_end)
+
+    # Pooled connections must not cross a fork (gunicorn --preload), a child
+    # drops inherited ones without closing the parent's socket
+    @event.listens_for(engine, 'connect')
+    def record_pid(dbapi_connection, connection_record):
+        connection_record.info['pid'] = os.getpid()
+
+    @event.listens_for(engine, 'checkout')
+    def check_pid(dbapi_connection, connection_record, connection_proxy):
+        if connection_record.info['pid'] != os.getpid():
+            connection_record.connection = connection_proxy.connection = None
+            raise exc.DisconnectionError('connection belongs to pid %d' % connection_record.info['pid'])
+
+    return engine
+
+
+def ping_connection(connection, branch):
+    """Checks pooled connections are alive before use, reconnecting once
+    when the database dropped them."""
+    if branch:
+        return
+    should_close_with_result = connection.should_close_with_result
+    connection.should_close_with_result = False
+    try:
+        connection.scalar(select([1]))
+    except exc.DBAPIError as err:
+        if not err.connection_invalidated:
+            raise
+        connection.scalar(select([1]))
+    finally:
+        connection.should_close_with_result = should_close_with_result
+
+
+def get_engine(url=DATABASE):
+    """Returns the process' engine for `url`, the primary by default,
+    creating it on first use so importing the app (e.g. in a preloading
+    gunicorn master) doesn't connect."""
+    engine = _engines.get(url)
+    if engine is None:
+        with _engine_lock:
+            engine = _engines.get(url)
+            if engine is None:
+                engine = _engines[url] = create_app_engine(url)
+    return engine
+
+
+def get_engines():
+    return [get_engine(url) for url in (DATABASE, DATABASE_REPLICA) if url]
+
+
 def get_db():
     """Opens a new database connection if there is none yet for the
     current application context.
     """
     top = _app_ctx_stack.top
     if not hasattr(top, 'db'):
-        top.db = engine.connect()
+        top.db = get_engine().connect()
     return top.db
 
 
+def use_replica():
+    """Whether the current request can read from the replica: a GET that
+    hasn't written nor marked itself primary_required, from a client that
+    hasn't written in the last DATABASE_REPLICA_STICKY seconds (so the
+    redirect after a POST sees its changes)."""
+    if not DATABASE_REPLICA or not has_request_context():
+        return False
+    if request.method not in ('GET', 'HEAD') or g.get('use_primary'):
+        return False
+    if session.get('primary_until', 0) > datetime.now(pytz.utc).timestamp():
+        return False
+    top = _app_ctx_stack.top
+    return not (hasattr(top, 'db') and top.db.in_transaction())
+
+
+def get_read_engine():
+    return get_engine(DATABASE_REPLICA) if use_replica() else get_engine()
+
+
+def get_read_db():
+    """Returns the connection for read-only queries, the replica's when
+    use_replica() and the primary's otherwise."""
+    if not use_replica():
+        return get_db()
+    top = _app_ctx_stack.top
+    if not hasattr(top, 'replica_db'):
+        top.replica_db = get_engine(DATABASE_REPLICA).connect()
+    return top.replica_db
+
+
+def use_primary():
+    """Makes the rest of the request read from the primary."""
+    if has_request_context():
+        g.use_primary = True
+
+
+def get_write_db():
+    """Returns the primary's connection, the request and the client's next
+    ones (see use_replica) then read from the primary too."""
+    use_primary()
+    if has_request_context():
+        g.db_wrote = True
+    return get_db()
+
+
+def primary_required(func):
+    """For GET handlers that write, so what they read before writing is
+    current."""
+    @wraps(func)
+    def decorated_function(*args, **kwargs):
+        use_primary()
+        return func(*args, **kwargs)
+    return decorated_function
+
+
+@app.after_request
+def stick_to_primary(response):
+    if DATABASE_REPLICA and g.get('db_wrote'):
+        session['primary_until'] = datetime.now(pytz.utc).timestamp() + DATABASE_REPLICA_STICKY
+    return response
+
+
 @app.teardown_appcontext
 def close_database(exception):
     """Closes the database again at the end of the request."""
     top = _app_ctx_stack.top
     if hasattr(top, 'db'):
         top.db.close()
+    if hasattr(top, 'replica_db'):
+        top.replica_db.close()
 
 
 def db_exec(ins, **kwargs):
-    return get_db().execute(ins, **kwargs)
+    """Executes `ins`, on the replica for a SELECT when use_replica()."""
+    if isinstance(ins, SelectBase):
+        return get_read_db().execute(ins, **kwargs)
+    return get_write_db().execute(ins, **kwargs)
+
+
+def db_exec_many(ins, rows):
+    return get_write_db().execute(ins, rows)
 
 
 def db_get_where(table, where):
@@ -221,15 +1155,204 @@ def db_get_where(table, where):
     result = db_exec(s)
     row = result.fetchone()
     result.close()
-    return objectify(row)
+    return objectify(row, row_class(table))
 
 
-def db_find_where(table, where):
-    s = select([table]).where(where)
+def db_find_where(table, where, *order_by):
+    s = select([table]).where(where).order_by(*order_by)
     result = db_exec(s)
     rows = result.fetchall()
     result.close()
-    return [objectify(row) for row in rows]
+    from_row = row_class(table).from_row
+    return [from_row(row) for row in rows]
+
+
+# Caches
+# ######################################
+
+# Per process, entries are shared between requests and must not be mutated
+users_cache = LRUCache(CACHE_SIZE, CACHE_TTL)
+accounts_cache = LRUCache(CACHE_SIZE, CACHE_TTL)
+
+
+def get_user(user_id):
+    user = users_cache.get(user_id)
+    if user is None:
+        user = db_get_where(userst, usersc.user_id == user_id)
+        if user is not None:
+            users_cache.set(user_id, user)
+    return user
+
+
+def get_user_accounts(user_id, refresh=False):
+    """Returns the user's accounts as an account_id -> account index."""
+    user_accounts = None if refresh else accounts_cache.get(user_id)
+    if user_accounts is None:
+        user_accounts = OrderedDict(
+            (a.account_id, a)
+            for a in db_find_where(accountst, accountsc.user_id == user_id, accountsc.account_id)
+        )
+        accounts_cache.set(user_id, user_accounts)
+    return user_accounts
+
+
+if FRAGMENT_CACHE == 'filesystem':
+    fragment_store = FilesystemFragmentStore(FRAGMENT_CACHE_DIR)
+elif FRAGMENT_CACHE == 'memory':
+    fragment_store = MemoryFragmentStore(FRAGMENT_CACHE_BYTES)
+else:
+    fragment_store = NullFragmentStore()
+
+
+def account_fragment(account_id, name, version, render):
+    """Returns the account's `name` fragment for a data `version`, calling
+    `render` only when it isn't cached. Keeps one version per fragment."""
+    key = 'account-%d-%s-%s' % (account_id, name, version)
+    html = fragment_store.get(key)
+    if html is None:
+        fragment_store.delete_prefix('account-%d-%s-' % (account_id, name))
+        html = render()
+        fragment_store.set(key, html)
+    return Markup(html)
+
+
+def invalidate_account_fragments(account_id):
+    fragment_store.delete_prefix('account-%d-' % account_id)
+
+
+@app.route('/_cache')
+def cache_stats():
+    """Exposes this worker's cache stats, in debug mode only."""
+    if not app.debug:
+        return abort(404)
+    return json.dumps({
+        'users': users_cache.stats(),
+        'accounts': accounts_cache.stats(),
+        'quotes': quote_cache.quotes.stats(),
+    }), 200, {'Content-Type': 'application/json'}
+
+
+# Profiling
+# ######################################
+
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram:
+    """Prometheus style cumulative histogram."""
+
+    def __init__(self):
+        self.buckets = [0] * len(METRICS_BUCKETS)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for (i, bound) in enumerate(METRICS_BUCKETS):
+            if value <= bound:
+                self.buckets[i] += 1
+
+
+# (metric, endpoint) -> Histogram or counter value, for this worker process
+metrics = {}
+metrics_lock = threading.Lock()
+
+METRICS_HELP = OrderedDict([
+    ('trade_log_request_duration_seconds', ('histogram', 'Request wall time.')),
+    ('trade_log_sql_duration_seconds', ('histogram', 'Time spent in SQL per request.')),
+    ('trade_log_template_duration_seconds', ('histogram', 'Time spent rendering templates per request.')),
+    ('trade_log_sql_queries_total', ('counter', 'SQL statements executed.')),
+])
+
+
+def profile_query_start(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('profile_query_start', []).append(perf_counter())
+
+
+def profile_query_end(conn, cursor, statement, parameters, context, executemany):
+    elapsed = perf_counter() - conn.info['profile_query_start'].pop()
+    if has_request_context() and 'profile' in g:
+        g.profile['sql_count'] += 1
+        g.profile['sql'] += elapsed
+
+
+def render_template(template_name, **context):
+    """Renders a template, timing it for the request's profile."""
+    if not PROFILING or 'profile' not in g:
+        return flask.render_template(template_name, **context)
+    start = perf_counter()
+    try:
+        return flask.render_template(template_name, **context)
+    finally:
+        g.profile['template'] += perf_counter() - start
+
+
+def profile_request_start():
+    if PROFILING:
+        g.profile = {'start': perf_counter(), 'sql_count': 0, 'sql': 0, 'template': 0}
+
+
+# Ahead of every other before_request function, wherever they are
+# registered, so the SQL loading g.user and the accounts is counted
+app.before_request_funcs.setdefault(None, []).insert(0, profile_request_start)
+
+
+@app.after_request
+def profile_request_end(response):
+    if not PROFILING or 'profile' not in g:
+        return response
+    profile = g.profile
+    total = perf_counter() - profile['start']
+    endpoint = request.endpoint or 'none'
+    with metrics_lock:
+        for (name, value) in (
+            ('trade_log_request_duration_seconds', total),
+            ('trade_log_sql_duration_seconds', profile['sql']),
+            ('trade_log_template_duration_seconds', profile['template']),
+        ):
+            metrics.setdefault((name, endpoint), Histogram()).observe(value)
+        key = ('trade_log_sql_queries_total', endpoint)
+        metrics[key] = metrics.get(key, 0) + profile['sql_count']
+    response.headers['Server-Timing'] = ', '.join([
+        'sql;dur=%.2f;desc="%d queries"' % (profile['sql'] * 1000, profile['sql_count']),
+        'tpl;dur=%.2f' % (profile['template'] * 1000),
+        'total;dur=%.2f' % (total * 1000),
+    ])
+    return response
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Exposes this worker's metrics in the Prometheus text format."""
+    if not PROFILING:
+        return abort(404)
+    worker = os.getpid()
+    lines = []
+    with metrics_lock:
+        for (name, (kind, description)) in METRICS_HELP.items():
+            lines.append('# HELP %s %s' % (name, description))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for ((metric, endpoint), value) in sorted(metrics.items()):
+                if metric != name:
+                    continue
+                labels = 'endpoint="%s",worker="%d"' % (endpoint, worker)
+                if kind == 'counter':
+                    lines.append('%s{%s} %d' % (name, labels, value))
+                    continue
+                for (bound, count) in zip(METRICS_BUCKETS, value.buckets):
+                    lines.append('%s_bucket{%s,le="%s"} %d' % (name, labels, bound, count))
+                lines.append('%s_bucket{%s,le="+Inf"} %d' % (name, labels, value.count))
+                lines.append('%s_sum{%s} %f' % (name, labels, value.sum))
+                lines.append('%s_count{%s} %d' % (name, labels, value.count))
+    for kind in ('hits', 'misses'):
+        name = 'trade_log_cache_%s_total' % kind
+        lines.append('# HELP %s Cache %s.' % (name, kind))
+        lines.append('# TYPE %s counter' % name)
+        for (cache_name, cache) in (('users', users_cache), ('accounts', accounts_cache)):
+            count = cache.stats()[kind]
+            lines.append('%s{cache="%s",worker="%d"} %d' % (name, cache_name, worker, count))
+    return '\n'.join(lines) + '\n', 200, {'Content-Type': 'text/plain; version=0.0.4'}
 
 
 # Middlewares
@@ -239,17 +1362,18 @@ def db_find_where(table, where):
 def before_request():
     g.user = None
     if 'user_id' in session:
-        g.user = db_get_where(userst, usersc.user_id == session['user_id'])
+        g.user = get_user(session['user_id'])
 
 
 def load_account(func):
     @wraps(func)
     def decorated_function(*args, **kwargs):
-        g.account = None
-        g.accounts = db_find_where(accountst, accountsc.user_id == g.user.user_id)
-        for account in g.accounts:
-            if account.account_id == kwargs['account_id']:
-                g.account = account
+        user_accounts = get_user_accounts(g.user.user_id)
+        if kwargs['account_id'] not in user_accounts:
+            # Might have been created through another worker since cached
+            user_accounts = get_user_accounts(g.user.user_id, refresh=True)
+        g.account = user_accounts.get(kwargs['account_id'])
+        g.accounts = list(user_accounts.values())
         if not g.account:
             return redirect(url_for('accounts'))
         return func(*args, **kwargs)
@@ -279,6 +1403,1619 @@ def page_not_found(error):
     return 'This page does not exist', 404
 
 
+# P&L
+# ######################################
+
+PNL_FIELDS = (
+    'trade_count', 'profit', 'commissions', 'win_count', 'loss_count',
+    'win_total', 'loss_total', 'largest_win', 'largest_loss',
+)
+
+
+def trade_pnl_aggregates(where=None):
+    """Returns P&L aggregate expressions, by PNL_FIELDS name, over the trades
+    matching `where` (all trades when None)."""
+    if where is None:
+        where = true()
+    net = tradesc.profit - tradesc.commissions
+    win = and_(where, net >= 0)
+    loss = and_(where, net < 0)
+    return {
+        'trade_count': func.sum(case([(where, 1)], else_=0)),
+        'profit': func.sum(case([(where, tradesc.profit)], else_=0)),
+        'commissions': func.sum(case([(where, tradesc.commissions)], else_=0)),
+        'win_count': func.sum(case([(win, 1)], else_=0)),
+        'loss_count': func.sum(case([(loss, 1)], else_=0)),
+        'win_total': func.sum(case([(win, net)], else_=0)),
+        'loss_total': func.sum(case([(loss, net)], else_=0)),
+        'largest_win': func.max(case([(win, net)], else_=None)),
+        'largest_loss': func.min(case([(loss, net)], else_=None)),
+    }
+
+
+def daily_pnl_aggregates(where):
+    """Same as `trade_pnl_aggregates` but combining daily_pnl rows."""
+    aggregates = {
+        'largest_win': func.max(case([(where, daily_pnlc.largest_win)], else_=None)),
+        'largest_loss': func.min(case([(where, daily_pnlc.largest_loss)], else_=None)),
+    }
+    for name in PNL_FIELDS:
+        if name not in aggregates:
+            aggregates[name] = func.sum(case([(where, daily_pnlc[name])], else_=0))
+    return aggregates
+
+
+def pnl_totals(row, prefix=''):
+    # SUM/MIN/MAX are NULL when no rows match and come back as Decimal
+    # on Postgres, normalize to ints
+    totals = {}
+    for name in PNL_FIELDS:
+        value = row[prefix + name]
+        if name in ('largest_win', 'largest_loss'):
+            totals[name] = None if value is None else int(value)
+        else:
+            totals[name] = int(value or 0)
+    return totals
+
+
+def merge_pnl_totals(a, b):
+    totals = {}
+    for name in PNL_FIELDS:
+        if name in ('largest_win', 'largest_loss'):
+            values = [v for v in (a[name], b[name]) if v is not None]
+            pick = max if name == 'largest_win' else min
+            totals[name] = pick(values) if values else None
+        else:
+            totals[name] = a[name] + b[name]
+    return totals
+
+
+def pnl_stats(totals):
+    """Turns P&L totals into the stats shown in the account overview."""
+    return {
+        'trade_count': totals['trade_count'],
+        'profit': totals['profit'],
+        'commissions': totals['commissions'],
+        'profit_without_commissions': totals['profit'] - totals['commissions'],
+        'win_count': totals['win_count'],
+        'loss_count': totals['loss_count'],
+        'avg_win': totals['win_total'] / max(1, totals['win_count']),
+        'avg_loss': totals['loss_total'] / max(1, totals['loss_count']),
+        'largest_win': totals['largest_win'] or 0,
+        'largest_loss': totals['largest_loss'] or 0,
+        'accuracy': totals['win_count'] / max(1, totals['trade_count']),
+    }
+
+
+def day_bounds(day):
+    start = datetime.combine(day, time())
+    return (start, start + timedelta(days=1))
+
+
+def daily_pnl_select(where):
+    """Selects daily_pnl rows, in column order, for the trades matching
+    `where`."""
+    aggregates = trade_pnl_aggregates()
+    return select(
+        [tradesc.account_id, func.date(tradesc.last_order_date)] +
+        [aggregates[name] for name in PNL_FIELDS]
+    ).where(where).group_by(tradesc.account_id, func.date(tradesc.last_order_date))
+
+
+def refresh_daily_pnl(account_id, dates):
+    """Recomputes the account's daily_pnl rows for the days of `dates` from
+    that day's trades, as part of the caller's transaction if any."""
+    with get_db().begin():
+        for day in set(d.date() for d in dates if d is not None):
+            (start, end) = day_bounds(day)
+            db_exec(daily_pnlt.delete().where(and_(
+                daily_pnlc.account_id == account_id,
+                daily_pnlc.date == day,
+            )))
+            db_exec(daily_pnlt.insert().from_select(
+                [daily_pnlc.account_id, daily_pnlc.date] + [daily_pnlc[name] for name in PNL_FIELDS],
+                daily_pnl_select(and_(
+                    tradesc.account_id == account_id,
+                    tradesc.last_order_date >= start,
+                    tradesc.last_order_date < end,
+                )),
+            ))
+
+
+def rebuild_daily_pnl(conn):
+    conn.execute(daily_pnlt.delete())
+    conn.execute(daily_pnlt.insert().from_select(
+        [daily_pnlc.account_id, daily_pnlc.date] + [daily_pnlc[name] for name in PNL_FIELDS],
+        daily_pnl_select(true()),
+    ))
+
+
+def stats_cache_key(version, now):
+    # Windows move with time too, stats hold for the current minute
+    return '%d-%s' % (version, now.strftime('%Y%m%d%H%M'))
+
+
+def account_stats_periods(now):
+    """Returns the (name, start) overview windows ending at `now`."""
+    day_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    return [
+        ('day', day_start),
+        ('mtd', day_start.replace(day=1)),
+        ('month', now - timedelta(days=30)),
+        ('ytd', day_start.replace(month=1, day=1)),
+        ('year', now - timedelta(days=365)),
+    ]
+
+
+def account_stats_for_periods(account_id, periods, end):
+    """Computes the overview stats of every period ending at `end`, whole days from daily_pnl."""
+    today = end.date()
+    today_start = datetime.combine(today, time())
+    last_order_date = tradesc.last_order_date
+
+    trade_columns = []
+    trade_ranges = []
+    rollup_columns = []
+    first_days = []
+    for (name, start) in periods:
+        first_day = start.date()
+        if start > datetime.combine(first_day, time()):
+            first_day += timedelta(days=1)
+        first_days.append(first_day)
+        first_day_start = datetime.combine(first_day, time())
+
+        in_range = and_(last_order_date <= end, or_(
+            and_(last_order_date >= start, last_order_date < first_day_start),
+            last_order_date >= max(today_start, first_day_start),
+        ))
+        trade_ranges.append(in_range)
+        for (field, column) in trade_pnl_aggregates(in_range).items():
+            trade_columns.append(column.label(name + '_' + field))
+
+        in_rollup = and_(daily_pnlc.date >= first_day, daily_pnlc.date < today)
+        for (field, column) in daily_pnl_aggregates(in_rollup).items():
+            rollup_columns.append(column.label(name + '_' + field))
+
+    result = db_exec(select(trade_columns).where(and_(
+        tradesc.account_id == account_id,
+        or_(*trade_ranges),
+    )))
+    trade_row = result.fetchone()
+    result.close()
+
+    result = db_exec(select(rollup_columns).where(and_(
+        daily_pnlc.account_id == account_id,
+        daily_pnlc.date >= min(first_days),
+        daily_pnlc.date < today,
+    )))
+    rollup_row = result.fetchone()
+    result.close()
+
+    stats = {}
+    for (name, _) in periods:
+        totals = merge_pnl_totals(
+            pnl_totals(trade_row, name + '_'),
+            pnl_totals(rollup_row, name + '_'),
+        )
+        stats[name] = pnl_stats(totals)
+    return stats
+
+
+def trade_filters_where(account_id, filters):
+    """Returns the where clause of the account's trades matching the
+    `parse_trade_filters` filters. Dates apply to the trade's last order,
+    winners are the trades with a positive or nil P&L after commissions."""
+    where = [tradesc.account_id == account_id]
+    if 'symbol' in filters:
+        where.append(tradesc.symbol == filters['symbol'])
+    if 'side' in filters:
+        where.append(tradesc.is_short == (filters['side'] == 'short'))
+    if 'start' in filters:
+        where.append(tradesc.last_order_date >= filters['start'])
+    if 'end' in filters:
+        where.append(tradesc.last_order_date <= filters['end'])
+    if 'result' in filters:
+        net = tradesc.profit - tradesc.commissions
+        where.append(net >= 0 if filters['result'] == 'win' else net < 0)
+    return and_(*where)
+
+
+SYMBOL_STATS_SORTS = ('worst', 'best', 'count', 'symbol',)
+
+
+def symbol_stats(where, sort='worst'):
+    """Aggregates the overview stats of the trades matching `where` by
+    symbol, sorted by `sort` (one of SYMBOL_STATS_SORTS)."""
+    aggregates = trade_pnl_aggregates()
+    net = (aggregates['profit'] - aggregates['commissions']).label('net')
+    trade_count = aggregates['trade_count'].label('trade_count')
+    order_by = {
+        'worst': [net, tradesc.symbol],
+        'best': [net.desc(), tradesc.symbol],
+        'count': [trade_count.desc(), tradesc.symbol],
+        'symbol': [tradesc.symbol],
+    }[sort]
+    result = db_exec(
+        select([tradesc.symbol, net] + [
+            trade_count if name == 'trade_count' else column.label(name)
+            for (name, column) in aggregates.items()
+        ])
+        .where(where)
+        .group_by(tradesc.symbol)
+        .order_by(*order_by)
+    )
+    rows = result.fetchall()
+    result.close()
+    return [dict(symbol=row['symbol'], **pnl_stats(pnl_totals(row))) for row in rows]
+
+
+PORTFOLIO_PERIODS = ('day', 'mtd', 'ytd')
+
+
+def portfolio_stats(account_ids, now):
+    """Returns the dashboard's (stats by account_id, combined stats), from one grouped query."""
+    net = tradesc.profit - tradesc.commissions
+    columns = [
+        tradesc.account_id,
+        func.sum(case([(tradesc.quantity_outstanding != 0, 1)], else_=0)).label('open_count'),
+        func.sum(tradesc.cost_basis).label('cost_basis'),
+    ]
+    # Only the all time stats need every aggregate
+    for (name, start) in account_stats_periods(now):
+        if name in PORTFOLIO_PERIODS:
+            in_range = and_(tradesc.last_order_date >= start, tradesc.last_order_date <= now)
+            columns.append(func.sum(case([(in_range, net)], else_=0)).label(name))
+    for (field, column) in trade_pnl_aggregates().items():
+        columns.append(column.label('all_' + field))
+
+    result = db_exec(
+        select(columns)
+        .where(tradesc.account_id.in_(account_ids))
+        .group_by(tradesc.account_id)
+    )
+    rows = dict((row['account_id'], row) for row in result.fetchall())
+    result.close()
+
+    # Accounts without trades have no row
+    empty = dict.fromkeys(column.name for column in columns)
+    accounts = OrderedDict()
+    combined = dict.fromkeys(('open_count', 'cost_basis') + PORTFOLIO_PERIODS, 0)
+    combined_totals = None
+    for account_id in account_ids:
+        row = rows.get(account_id, empty)
+        stats = {}
+        for name in combined:
+            stats[name] = int(row[name] or 0)
+            combined[name] += stats[name]
+        totals = pnl_totals(row, 'all_')
+        stats['all'] = pnl_stats(totals)
+        if combined_totals is not None:
+            totals = merge_pnl_totals(combined_totals, totals)
+        combined_totals = totals
+        accounts[account_id] = stats
+    combined['all'] = pnl_stats(combined_totals)
+    return (accounts, combined)
+
+
+# Import
+# ######################################
+
+IMPORT_COLUMNS = ('date', 'symbol', 'type', 'quantity', 'price', 'commission',)
+IMPORT_BATCH_SIZE = 1000
+
+ImportSummary = namedtuple('ImportSummary', ['orders_count', 'trades_count', 'errors'])
+
+
+def import_orders(account_id, lines):
+    """Imports the orders of CSV `lines` into the account's trades per symbol, in file order."""
+    reader = csv.DictReader(lines)
+    missing = [c for c in IMPORT_COLUMNS if c not in (reader.fieldnames or [])]
+    if missing:
+        return ImportSummary(0, 0, [(1, 'Missing columns: %s' % ', '.join(missing))])
+
+    # symbol -> [trade_id, quantity outstanding]
+    positions = {}
+    open_trades = db_find_where(
+        tradest,
+        and_(tradesc.account_id == account_id, tradesc.quantity_outstanding != 0),
+        tradesc.last_order_date,
+    )
+    for t in open_trades:
+        positions[t.symbol] = [t.trade_id, t.quantity_outstanding]
+
+    touched = set()
+    errors = []
+    batch = []
+    orders_count = 0
+    with get_db().begin():
+        for (line, row) in enumerate(reader, 2):
+            (order, error) = parse_order_fields(row)
+            symbol = (row.get('symbol') or '').strip().upper()
+            if error is None and not symbol:
+                error = 'You have to enter the symbol you are trading'
+            if error is not None:
+                errors.append((line, error))
+                continue
+
+            position = positions.get(symbol)
+            if position is None or position[1] == 0:
+                result = db_exec(
+                    tradest.insert(),
+                    account_id=account_id,
+                    symbol=symbol,
+                    target_entry=order['price'],
+                    target_profit=0,
+                    target_stop=0,
+                    entry_reason='Imported',
+                    exit_reason='',
+                    analysis='',
+
+                    first_order_date=order['date'],
+                    last_order_date=order['date'],
+                    commissions=0,
+                    is_short=False,
+                    avg_buy_price=0,
+                    avg_sell_price=0,
+                    profit=0,
+                    quantity=0,
+                    quantity_outstanding=0,
+                    orders_count=0,
+                    buy_count=0,
+                    buy_price_total=0,
+                    sell_count=0,
+                    sell_price_total=0,
+                )
+                position = positions[symbol] = [result.inserted_primary_key[0], 0]
+            if order['type'] in BUY_ORDER_TYPES:
+                position[1] += order['quantity']
+            else:
+                position[1] -= order['quantity']
+
+            touched.add(position[0])
+            order.update(trade_id=position[0], account_id=account_id)
+            batch.append(order)
+            if len(batch) >= IMPORT_BATCH_SIZE:
+                db_exec_many(orderst.insert(), batch)
+                orders_count += len(batch)
+                batch = []
+
+        if batch:
+            db_exec_many(orderst.insert(), batch)
+            orders_count += len(batch)
+
+        days = []
+        for trade_id in sorted(touched):
+            trade = lock_trade(tradesc.trade_id == trade_id)
+            days.append(trade.last_order_date)
+            save_trade_lots(trade_id, compute_trade_fields(trade, load_trade_orders(trade_id)))
+            save_trade_computed_fields(trade)
+            days.append(trade.last_order_date)
+        sync_trade_search(touched)
+        refresh_daily_pnl(account_id, days)
+        bump_account_version(account_id)
+
+    return ImportSummary(orders_count, len(touched), errors)
+
+
+# Export
+# ######################################
+
+EXPORT_CHUNK_SIZE = 500
+
+EXPORT_COLUMNS = {
+    'trades': (
+        'trade_id', 'symbol', 'first_order_date', 'last_order_date', 'is_short',
+        'quantity', 'quantity_outstanding', 'orders_count', 'avg_buy_price',
+        'avg_sell_price', 'commissions', 'profit', 'target_entry',
+        'target_profit', 'target_stop', 'entry_reason', 'exit_reason',
+        'analysis',
+    ),
+    # Same columns as imports take, plus ids
+    'orders': (
+        'order_id', 'trade_id', 'date', 'symbol', 'type', 'quantity', 'price',
+        'commission',
+    ),
+}
+
+EXPORT_MONEY_COLUMNS = (
+    'avg_buy_price', 'avg_sell_price', 'commissions', 'profit', 'target_entry',
+    'target_profit', 'target_stop', 'price', 'commission',
+)
+
+
+def export_query(kind, account_id, start=None, end=None, symbol=None):
+    """Returns the select for an account's trades or orders export, in
+    date order."""
+    if kind == 'trades':
+        columns = [tradesc[name] for name in EXPORT_COLUMNS['trades']]
+        s = select(columns).where(tradesc.account_id == account_id)
+        date = tradesc.last_order_date
+    else:
+        columns = [tradesc.symbol if name == 'symbol' else ordersc[name]
+                   for name in EXPORT_COLUMNS['orders']]
+        s = select(columns).select_from(orderst.join(tradest)) \
+            .where(ordersc.account_id == account_id)
+        date = ordersc.date
+    if start is not None:
+        s = s.where(date >= start)
+    if end is not None:
+        s = s.where(date <= end)
+    if symbol:
+        s = s.where(tradesc.symbol == symbol.strip().upper())
+    return s.order_by(date, columns[0])
+
+
+def export_value(name, value):
+    if value is None:
+        return None
+    if name in EXPORT_MONEY_COLUMNS:
+        return format_decimal(value)
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%d %H:%M')
+    return value
+
+
+def export_rows(kind, query, fmt, engine=None):
+    """Yields the export as CSV or JSON text chunks of EXPORT_CHUNK_SIZE rows.
+
+    Uses its own connection (to `engine`, the primary by default) with a
+    server-side cursor (on Postgres) so only one chunk of rows is ever held
+    in memory."""
+    columns = EXPORT_COLUMNS[kind]
+    conn = (engine or get_engine()).connect()
+    try:
+        result = conn.execution_options(stream_results=True).execute(query)
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        if fmt == 'csv':
+            writer.writerow(columns)
+        else:
+            buf.write('[')
+        first = True
+        while True:
+            rows = result.fetchmany(EXPORT_CHUNK_SIZE)
+            if not rows:
+                break
+            for row in rows:
+                values = [export_value(name, row[i]) for (i, name) in enumerate(columns)]
+                if fmt == 'csv':
+                    writer.writerow(values)
+                else:
+                    buf.write(('\n' if first else ',\n') + json.dumps(dict(zip(columns, values))))
+                first = False
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+        result.close()
+        if fmt == 'json':
+            buf.write('\n]\n' if not first else ']\n')
+        yield buf.getvalue()
+    finally:
+        conn.close()
+
+
+# Benchmarks
+# ######################################
+
+def seed_bench_trade_orders(rng, start, max_fills):
+    """Generates the orders of one trade: scaling in then out of a long or
+    short position, left partially open one time out of ten."""
+    is_short = rng.random() < 0.3
+    (open_type, close_type) = ('sell_short', 'buy_to_cover') if is_short else ('buy', 'sell')
+    price = rng.randint(5 * 100, 500 * 100) * 1000
+    date = start
+    orders = []
+    position = 0
+    for _ in range(rng.randint(1, max_fills)):
+        quantity = rng.randint(1, 20) * 10
+        position += quantity
+        price += rng.randint(-price // 100, price // 100)
+        date += timedelta(minutes=rng.randint(1, 120))
+        orders.append(OrderRow(date=date, type=open_type, quantity=quantity, price=price, commission=495000))
+    if rng.random() < 0.9:
+        exits = rng.randint(1, max_fills)
+        for i in range(exits):
+            quantity = position if i == exits - 1 else rng.randint(0, position // 10) * 10
+            if quantity == 0:
+                continue
+            position -= quantity
+            price += rng.randint(-price // 20, price // 20)
+            date += timedelta(minutes=rng.randint(1, 60 * 24 * 3))
+            orders.append(OrderRow(date=date, type=close_type, quantity=quantity, price=price, commission=495000))
+    return orders
+
+
+def seed_bench_user(rng, accounts_count, trades_count, max_fills):
+    """Creates a bench user with generated accounts, trades and orders and
+    returns its id."""
+    result = db_exec(userst.insert(), username='bench', email='', password=generate_password_hash('bench'))
+    user_id = result.inserted_primary_key[0]
+    db_exec(
+        userst.update().where(usersc.user_id == user_id),
+        username='bench%d' % user_id,
+        email='bench%d@example.com' % user_id,
+    )
+    symbols = ['SYM%d' % i for i in range(200)]
+    now = datetime.now(NEW_YORK_TZ).replace(tzinfo=None)
+
+    for n in range(accounts_count):
+        result = db_exec(accountst.insert(), user_id=user_id, name='Bench %d' % (n + 1), cash=10000000000)
+        account_id = result.inserted_primary_key[0]
+        with get_db().begin():
+            batch = []
+            trade_ids = []
+            open_trade_ids = []
+            for _ in range(trades_count):
+                start = now - timedelta(days=rng.randint(0, 730), minutes=rng.randint(0, 60 * 24))
+                orders = seed_bench_trade_orders(rng, start, max_fills)
+                trade = TradeRow()
+                open_lots = compute_trade_fields(trade, orders)
+                values = dict((k, getattr(trade, k)) for k in TRADE_COMPUTED_FIELDS)
+                result = db_exec(
+                    tradest.insert(),
+                    account_id=account_id,
+                    symbol=rng.choice(symbols),
+                    target_entry=orders[0].price,
+                    target_profit=orders[0].price * 11 // 10,
+                    target_stop=orders[0].price * 95 // 100,
+                    entry_reason='Generated by seed-bench',
+                    exit_reason='',
+                    analysis='',
+                    **values
+                )
+                trade_ids.append(result.inserted_primary_key[0])
+                if open_lots:
+                    open_trade_ids.append(result.inserted_primary_key[0])
+                for o in orders:
+                    o.trade_id = result.inserted_primary_key[0]
+                    o.account_id = account_id
+                    batch.append(dict((k, getattr(o, k)) for k in o.__slots__ if k != 'order_id'))
+                if len(batch) >= IMPORT_BATCH_SIZE:
+                    db_exec_many(orderst.insert(), batch)
+                    batch = []
+            if batch:
+                db_exec_many(orderst.insert(), batch)
+            # Once the orders have ids for the lots to reference
+            for trade_id in open_trade_ids:
+                save_trade_lots(trade_id, compute_trade_fields(TradeRow(), load_trade_orders(trade_id)))
+            sync_trade_search(trade_ids)
+    return user_id
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of sorted `values`."""
+    if not values:
+        return 0
+    return values[max(0, int(round(p / 100.0 * len(values))) - 1)]
+
+
+def bench_scenario(run, count):
+    """Times `count` calls of `run` and counts their SQL statements, then
+    measures the peak memory of one more call."""
+    queries = [0]
+
+    def count_query(*args):
+        queries[0] += 1
+
+    timings = []
+    for engine in get_engines():
+        event.listen(engine, 'before_cursor_execute', count_query)
+    try:
+        for i in range(count):
+            start = perf_counter()
+            run(i)
+            timings.append((perf_counter() - start) * 1000)
+    finally:
+        for engine in get_engines():
+            event.remove(engine, 'before_cursor_execute', count_query)
+
+    tracemalloc.start()
+    try:
+        run(count)
+        (_, peak) = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    timings.sort()
+    return {
+        'count': count,
+        'mean_ms': sum(timings) / max(1, count),
+        'p50_ms': percentile(timings, 50),
+        'p95_ms': percentile(timings, 95),
+        'p99_ms': percentile(timings, 99),
+        'queries': queries[0] / max(1, count),
+        'peak_memory_kib': peak // 1024,
+    }
+
+
+STARTUP_PHASES = ('import', 'create_app', 'first_response', 'second_response', 'process',)
+
+# Runs in a fresh interpreter, from the directory containing the package
+STARTUP_SCRIPT = '''
+import sys, json
+from time import perf_counter
+start = perf_counter()
+from trade_log import trade_log
+imported = perf_counter()
+app = trade_log.create_app()
+created = perf_counter()
+client = app.test_client()
+client.get(sys.argv[1])
+first = perf_counter()
+client.get(sys.argv[1])
+second = perf_counter()
+print(json.dumps({
+    'import': (imported - start) * 1000,
+    'create_app': (created - imported) * 1000,
+    'first_response': (first - created) * 1000,
+    'second_response': (second - first) * 1000,
+}))
+'''
+
+
+def measure_startup(path):
+    """Starts a worker-like process which imports the app, creates it and
+    answers `path` twice. Returns the STARTUP_PHASES timings in ms,
+    `process` being the wall time from spawn to the first response."""
+    start = perf_counter()
+    output = subprocess.check_output(
+        [sys.executable, '-c', STARTUP_SCRIPT, path],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    )
+    end = perf_counter()
+    timings = json.loads(output.decode().splitlines()[-1])
+    timings['process'] = (end - start) * 1000 - timings['second_response']
+    return timings
+
+
+def bench_rolled_back(run, count):
+    """bench_scenario for the scenarios writing, in a transaction rolled
+    back after so every run measures the same data. The test client's
+    requests share the command's app context, so its connection."""
+    transaction = get_db().begin()
+    try:
+        return bench_scenario(run, count)
+    finally:
+        transaction.rollback()
+
+
+def run_bench(account_id, count):
+    """Drives the hot paths of an account through the test client and
+    returns the results by scenario, with enough context to compare runs."""
+    account = db_get_where(accountst, accountsc.account_id == account_id)
+    result = db_exec(select([tradesc.trade_id]).where(tradesc.account_id == account_id))
+    trade_ids = [row[0] for row in result]
+    result.close()
+    rng = random.Random(count)
+    client = app.test_client()
+    with client.session_transaction() as client_session:
+        client_session['user_id'] = account.user_id
+
+    def get(url):
+        response = client.get(url)
+        assert response.status_code == 200, url
+
+    def account_page(i):
+        get('/accounts/%d' % account_id)
+
+    def trade_page(i):
+        get('/accounts/%d/trades/%d' % (account_id, rng.choice(trade_ids)))
+
+    def create_order(i):
+        trade_id = rng.choice(trade_ids)
+        response = client.post('/accounts/%d/trades/%d/create' % (account_id, trade_id), data={
+            'date': format_datetime(datetime.now() - timedelta(days=rng.randint(0, 365))),
+            'type': rng.choice(ORDER_TYPES),
+            'quantity': str(rng.randint(1, 10)),
+            'price': '%.2f' % rng.uniform(5, 500),
+            'commission': '4.95',
+        })
+        assert response.status_code == 302
+
+    def recompute_trade(i):
+        with get_db().begin():
+            trade = lock_trade(tradesc.trade_id == rng.choice(trade_ids))
+            update_trade_computed_fields(trade)
+
+    try:
+        revision = subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(__file__), stderr=subprocess.DEVNULL,
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+
+    return {
+        'revision': revision,
+        'date': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'database': get_engine().dialect.name,
+        'account_id': account_id,
+        'trades': len(trade_ids),
+        'scenarios': {
+            'account': bench_scenario(account_page, count),
+            'trade': bench_scenario(trade_page, count),
+            'orders_create': bench_rolled_back(create_order, count),
+            'update_trade_computed_fields': bench_rolled_back(recompute_trade, count),
+        },
+    }
+
+
+# API
+# ######################################
+
+STATS_MONEY_FIELDS = (
+    'profit', 'commissions', 'profit_without_commissions', 'avg_win',
+    'avg_loss', 'largest_win', 'largest_loss',
+)
+
+
+def bump_account_version(account_id):
+    """Marks the account's trades/orders as changed."""
+    db_exec(accountst.update().where(accountsc.account_id == account_id).values(
+        version=accountsc.version + 1,
+    ))
+    invalidate_account_fragments(account_id)
+
+
+def get_account_version(account_id):
+    # Not from the accounts cache, which can be stale
+    result = db_exec(select([accountsc.version]).where(accountsc.account_id == account_id))
+    version = result.scalar()
+    result.close()
+    return version
+
+
+def conditional_json(etag, build):
+    """Answers 304 when the client has `etag`, otherwise the JSON of
+    `build()`, which is only called then."""
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = jsonify(build())
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+TRADES_PAGE_SIZE = 50
+TRADES_PAGE_MAX = 500
+
+
+def format_trades_cursor(trade):
+    return '%s_%d' % (trade.last_order_date.strftime('%Y%m%d%H%M%S%f'), trade.trade_id)
+
+
+def parse_trades_cursor(text):
+    try:
+        (date, trade_id) = text.split('_')
+        return (datetime.strptime(date, '%Y%m%d%H%M%S%f'), int(trade_id))
+    except ValueError:
+        return None
+
+
+def trades_page(where, after=None, limit=TRADES_PAGE_SIZE):
+    """Returns a page of the trades matching `where`, latest first, and the
+    cursor of the next page (None on the last one).
+
+    Pages are keyed on (last_order_date, trade_id) rather than offset, `after`
+    being the parsed cursor of the previous page, so every page is a seek
+    in trade_account_id_last_order_date_idx however deep it is."""
+    if after is not None:
+        (date, trade_id) = after
+        where = and_(
+            where,
+            tradesc.last_order_date <= date,
+            or_(tradesc.last_order_date < date, tradesc.trade_id < trade_id),
+        )
+    result = db_exec(
+        select([tradest]).where(where)
+        .order_by(tradesc.last_order_date.desc(), tradesc.trade_id.desc())
+        .limit(limit + 1)
+    )
+    trades = [TradeRow.from_row(row) for row in result.fetchall()]
+    result.close()
+    if len(trades) <= limit:
+        return (trades, None)
+    return (trades[:limit], format_trades_cursor(trades[limit - 1]))
+
+
+TRADE_JSON_COLUMNS = ('account_id',) + EXPORT_COLUMNS['trades']
+
+
+def trade_json(trade):
+    # Same columns as the export, the running totals are internal
+    return dict((name, export_value(name, getattr(trade, name))) for name in TRADE_JSON_COLUMNS)
+
+
+@app.route('/api/accounts/<int:account_id>/stats')
+@sign_in_required
+@load_account
+def api_account_stats(account_id):
+    now = datetime.now(NEW_YORK_TZ).replace(tzinfo=None)
+    etag = 'stats-%d-%s' % (account_id, stats_cache_key(get_account_version(account_id), now))
+
+    # Open positions are marked to quotes cached for up to QUOTE_TTL
+    etag += '-%d' % quotes_generation()
+
+    def build():
+        (_, positions) = mark_to_market(load_open_trades(account_id))
+        stats = account_stats_for_periods(account_id, account_stats_periods(now), now)
+        for period in stats.values():
+            for name in STATS_MONEY_FIELDS:
+                period[name] = format_decimal(period[name])
+        for name in ('cost_basis', 'market_value', 'unrealized'):
+            positions[name] = format_decimal(positions[name])
+        return {'account_id': account_id, 'periods': stats, 'open_positions': positions}
+
+    return conditional_json(etag, build)
+
+
+@app.route('/api/accounts/<int:account_id>/trades')
+@sign_in_required
+@load_account
+def api_account_trades(account_id):
+    (filters, error) = parse_trade_filters(request.args)
+    # All of the trades unless a page is asked for
+    paginated = 'limit' in request.args or 'after' in request.args
+    after = None
+    if error is None and request.args.get('after'):
+        after = parse_trades_cursor(request.args['after'])
+        if after is None:
+            error = 'Invalid page cursor'
+    limit = parse_int(request.args.get('limit') or str(TRADES_PAGE_SIZE))
+    if error is None and (limit is None or not 0 < limit <= TRADES_PAGE_MAX):
+        error = 'The limit must be between 1 and %d' % TRADES_PAGE_MAX
+    if error is not None:
+        return jsonify({'error': error}), 400
+    etag = 'trades-%d-%d-%s' % (
+        account_id, get_account_version(account_id), md5(request.query_string).hexdigest())
+
+    def build():
+        where = trade_filters_where(account_id, filters)
+        if not paginated:
+            trades = db_find_where(tradest, where, tradesc.last_order_date.desc(), tradesc.trade_id.desc())
+            return {'account_id': account_id, 'trades': [trade_json(t) for t in trades]}
+        (trades, next_cursor) = trades_page(where, after, limit)
+        return {
+            'account_id': account_id,
+            'trades': [trade_json(t) for t in trades],
+            'next': next_cursor,
+        }
+
+    return conditional_json(etag, build)
+
+
+@app.route('/api/accounts/<int:account_id>/trades/<int:trade_id>/orders', methods=['POST'])
+@sign_in_required
+@load_account
+def api_trade_orders_create(account_id, trade_id):
+    trade = db_get_where(tradest, and_(tradesc.trade_id == trade_id, tradesc.account_id == account_id))
+    if not trade:
+        return jsonify({'error': 'Trade not found'}), 404
+    body = request.get_json(silent=True)
+    rows = body.get('orders') if isinstance(body, dict) else None
+    if not isinstance(rows, list) or not all(isinstance(r, dict) for r in rows):
+        return jsonify({'error': 'Expected {"orders": [{"date", "type", "quantity", "price", "commission"}]}'}), 400
+    # Numbers are parsed from their text so prices stay exact decimals
+    (orders, errors) = parse_orders_batch([
+        dict((k, v if v is None or isinstance(v, str) else str(v)) for (k, v) in r.items())
+        for r in rows
+    ])
+    if errors:
+        return jsonify({
+            'error': errors[0][1] if not errors[0][0] else 'Invalid orders, none were added',
+            'orders': [{'index': i - 1, 'error': error} for (i, error) in errors if i],
+        }), 400
+    trade = create_trade_orders(trade, orders)
+    return jsonify({
+        'account_id': account_id,
+        'orders_count': len(orders),
+        'trade': trade_json(trade),
+    }), 201
+
+
+@app.route('/api/accounts/<int:account_id>/symbols')
+@sign_in_required
+@load_account
+def api_account_symbols(account_id):
+    (filters, error) = parse_trade_filters(request.args)
+    sort = request.args.get('sort', 'worst')
+    if error is None and sort not in SYMBOL_STATS_SORTS:
+        error = 'No hax plz'
+    if error is not None:
+        return jsonify({'error': error}), 400
+    etag = 'symbols-%d-%d-%s' % (
+        account_id, get_account_version(account_id), md5(request.query_string).hexdigest())
+
+    def build():
+        symbols = symbol_stats(trade_filters_where(account_id, filters), sort)
+        for stats in symbols:
+            for name in STATS_MONEY_FIELDS:
+                stats[name] = format_decimal(stats[name])
+        return {'account_id': account_id, 'symbols': symbols}
+
+    return conditional_json(etag, build)
+
+
+# Analytics
+# ######################################
+
+TRADING_DAYS_PER_YEAR = 252
+EQUITY_CURVE_POINTS = 500
+
+
+def load_closed_trades(account_id):
+    """Loads the account's closed trades, by close date, as columnar arrays."""
+    columns = (
+        tradesc.last_order_date, tradesc.profit, tradesc.commissions,
+        tradesc.target_entry, tradesc.target_stop, tradesc.quantity,
+    )
+    result = db_exec(select(columns).where(and_(
+        tradesc.account_id == account_id,
+        tradesc.quantity_outstanding == 0,
+        tradesc.orders_count > 0,
+    )).order_by(tradesc.last_order_date))
+    rows = result.fetchall()
+    result.close()
+    (dates, profit, commissions, target_entry, target_stop, quantity) = \
+        zip(*rows) if rows else ((),) * 6
+    return {
+        'date': np.array(dates, dtype='datetime64[m]'),
+        'profit': np.array(profit, dtype=np.int64),
+        'commissions': np.array(commissions, dtype=np.int64),
+        'target_entry': np.array(target_entry, dtype=np.int64),
+        'target_stop': np.array(target_stop, dtype=np.int64),
+        'quantity': np.array(quantity, dtype=np.int64),
+    }
+
+
+def account_analytics(account, trades):
+    """Computes the equity curve and risk metrics of the closed `trades`
+    arrays (see `load_closed_trades`), without per-trade Python loops.
+
+    Money is in the usual 1/100000 $ units. Sharpe and Sortino are
+    annualized from the returns of the days trades were closed on."""
+    net = trades['profit'] - trades['commissions']
+    count = len(net)
+    equity = account.cash + np.cumsum(net)
+
+    # Drawdown against the running peak, the account cash being the first
+    peaks = np.maximum.accumulate(np.concatenate(([account.cash], equity)))[1:]
+    drawdown = equity - peaks
+    at_peak = np.where(equity >= peaks, np.arange(count), -1)
+    last_peak = np.maximum.accumulate(at_peak) if count else at_peak
+    if count:
+        # Before the first peak, the drawdown started with the first trade
+        start = trades['date'][np.maximum(last_peak, 0)]
+        durations = np.where(last_peak >= 0, trades['date'] - start, trades['date'] - trades['date'][0])
+        max_drawdown_duration = durations.max().astype('timedelta64[m]').astype(np.int64) / (60 * 24.0)
+    else:
+        max_drawdown_duration = 0.0
+
+    # Daily returns over the equity at the start of each day
+    days, day_index = np.unique(trades['date'].astype('datetime64[D]'), return_inverse=True)
+    daily = np.bincount(day_index.ravel(), weights=net, minlength=len(days))
+    day_start_equity = account.cash + np.cumsum(daily) - daily
+    with np.errstate(divide='ignore', invalid='ignore'):
+        returns = np.where(day_start_equity > 0, daily / day_start_equity, 0.0)
+    annualize = np.sqrt(TRADING_DAYS_PER_YEAR)
+    sharpe = returns.mean() / returns.std() * annualize if len(returns) > 1 and returns.std() else 0.0
+    downside = np.sqrt(np.mean(np.minimum(returns, 0) ** 2)) if len(returns) else 0.0
+    sortino = returns.mean() / downside * annualize if downside else 0.0
+
+    wins = net[net >= 0]
+    losses = net[net < 0]
+    risk = np.abs(trades['target_entry'] - trades['target_stop']) * trades['quantity']
+    r_multiples = net[risk > 0] / risk[risk > 0]
+
+    sample = np.unique(np.linspace(0, count - 1, min(count, EQUITY_CURVE_POINTS)).astype(np.int64))
+    return {
+        'trade_count': count,
+        'net_profit': int(net.sum()),
+        'ending_equity': int(equity[-1]) if count else account.cash,
+        'max_drawdown': int(-drawdown.min()) if count else 0,
+        'max_drawdown_pct': float(-(drawdown / peaks).min() * 100) if count and peaks.min() > 0 else 0.0,
+        'max_drawdown_days': float(max_drawdown_duration),
+        'sharpe': float(sharpe),
+        'sortino': float(sortino),
+        'expectancy': float(net.mean()) if count else 0.0,
+        'profit_factor': float(wins.sum() / -losses.sum()) if len(losses) and losses.sum() else None,
+        'avg_r_multiple': float(r_multiples.mean()) if len(r_multiples) else None,
+        'r_multiple_count': len(r_multiples),
+        'equity_curve': [
+            (str(trades['date'][i]).replace('T', ' '), int(equity[i])) for i in sample
+        ],
+    }
+
+
+@app.route('/api/accounts/<int:account_id>/analytics')
+@sign_in_required
+@load_account
+def api_account_analytics(account_id):
+    etag = 'analytics-%d-%d' % (account_id, get_account_version(account_id))
+
+    def build():
+        analytics = account_analytics(g.account, load_closed_trades(account_id))
+        for name in ('net_profit', 'ending_equity', 'max_drawdown', 'expectancy'):
+            analytics[name] = format_decimal(analytics[name])
+        analytics['equity_curve'] = [
+            {'date': date, 'equity': format_decimal(equity)}
+            for (date, equity) in analytics['equity_curve']
+        ]
+        return {'account_id': account_id, 'analytics': analytics}
+
+    return conditional_json(etag, build)
+
+
+# Quotes
+# ######################################
+
+Quote = namedtuple('Quote', ['symbol', 'price', 'date'])
+
+# Cached for symbols the provider has no quote for
+NO_QUOTE = Quote(None, None, None)
+
+quote_metadata = MetaData()
+quotes = Table(
+    'quote', quote_metadata,
+    Column('symbol', Text, primary_key=True),
+    Column('price', BigInteger, nullable=False),
+    Column('date', DateTime),
+)
+quotest = quotes
+quotesc = quotes.c
+
+
+def read_quotes_csv(lines):
+    """Reads `symbol,price[,date]` CSV lines to a symbol -> Quote dict,
+    skipping invalid rows."""
+    result = {}
+    for row in csv.DictReader(lines):
+        symbol = (row.get('symbol') or '').strip().upper()
+        price = parse_decimal_to_bigint((row.get('price') or '').strip())
+        if symbol and price is not None:
+            result[symbol] = Quote(symbol, price, parse_datetime((row.get('date') or '').strip()))
+    return result
+
+
+class FileQuoteProvider:
+    """Quotes from a `symbol,price[,date]` CSV file, re-read when it
+    changes. No quotes while the file doesn't exist."""
+
+    def __init__(self, path):
+        self.path = path
+        self.mtime = None
+        self.quotes = {}
+        self.lock = threading.Lock()
+
+    def get_quotes(self, symbols):
+        with self.lock:
+            try:
+                mtime = os.stat(self.path).st_mtime
+            except FileNotFoundError:
+                (mtime, self.quotes) = (None, {})
+            if mtime is not None and mtime != self.mtime:
+                with open(self.path, encoding='utf-8-sig') as f:
+                    self.quotes = read_quotes_csv(f)
+            self.mtime = mtime
+            return dict((s, self.quotes[s]) for s in symbols if s in self.quotes)
+
+
+class DatabaseQuoteProvider:
+    """Quotes from the `quote` table of their own (SQLite by default)
+    database, looked up with one query per batch of symbols."""
+
+    def __init__(self, url):
+        self.url = url
+        self.engine = None
+        self.lock = threading.Lock()
+
+    def get_engine(self):
+        with self.lock:
+            if self.engine is None:
+                self.engine = create_engine(self.url)
+                quote_metadata.create_all(self.engine)
+            return self.engine
+
+    def get_quotes(self, symbols):
+        result = {}
+        symbols = list(symbols)
+        with self.get_engine().connect() as conn:
+            # Stay under SQLite's bound parameters limit
+            for i in range(0, len(symbols), 500):
+                rows = conn.execute(select([quotest]).where(quotesc.symbol.in_(symbols[i:i + 500])))
+                for row in rows:
+                    result[row.symbol] = Quote(row.symbol, row.price, row.date)
+        return result
+
+    def set_quotes(self, new_quotes):
+        new_quotes = list(new_quotes)
+        with self.get_engine().begin() as conn:
+            for i in range(0, len(new_quotes), 500):
+                batch = new_quotes[i:i + 500]
+                conn.execute(quotest.delete().where(quotesc.symbol.in_([q.symbol for q in batch])))
+                conn.execute(quotest.insert(), [q._asdict() for q in batch])
+
+
+class NullQuoteProvider:
+    def get_quotes(self, symbols):
+        return {}
+
+
+class QuoteCache:
+    """Caches a provider's quotes in process for `ttl` seconds.
+
+    The symbols missing from the cache are looked up in a single batch per
+    call. Concurrent lookups are coalesced: a symbol already being fetched
+    by another thread is waited for instead of fetched again."""
+
+    def __init__(self, provider, maxsize, ttl):
+        self.provider = provider
+        self.quotes = LRUCache(maxsize, ttl)
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def get_quotes(self, symbols):
+        """Returns a symbol -> Quote dict of the `symbols` with a quote."""
+        result = {}
+        fetch = []
+        waits = []
+        with self.lock:
+            for symbol in set(symbols):
+                quote = self.quotes.get(symbol)
+                if quote is not None:
+                    result[symbol] = quote
+                elif symbol in self.pending:
+                    waits.append((symbol, self.pending[symbol]))
+                else:
+                    fetch.append(symbol)
+            done = threading.Event()
+            for symbol in fetch:
+                self.pending[symbol] = done
+
+        if fetch:
+            try:
+                fetched = self.provider.get_quotes(fetch)
+                for symbol in fetch:
+                    result[symbol] = fetched.get(symbol, NO_QUOTE)
+                    self.quotes.set(symbol, result[symbol])
+            except Exception:
+                # Pages still render, at entry prices
+                app.logger.exception('quote lookup failed')
+            finally:
+                with self.lock:
+                    for symbol in fetch:
+                        del self.pending[symbol]
+                done.set()
+
+        for (symbol, event) in waits:
+            event.wait()
+            quote = self.quotes.get(symbol)
+            if quote is not None:
+                result[symbol] = quote
+        return dict((s, q) for (s, q) in result.items() if q is not NO_QUOTE)
+
+
+if QUOTE_PROVIDER == 'sqlite':
+    quote_provider = DatabaseQuoteProvider(QUOTES_DATABASE_URL)
+elif QUOTE_PROVIDER == 'file':
+    quote_provider = FileQuoteProvider(QUOTES_FILE)
+else:
+    quote_provider = NullQuoteProvider()
+quote_cache = QuoteCache(quote_provider, CACHE_SIZE, QUOTE_TTL)
+
+
+def mark_to_market(trades):
+    """Values the open positions of `trades` at their symbol's quote, all
+    looked up in one batch. Returns the open positions, each a dict with
+    the trade, quote (None when there's none) and, when quoted, the market
+    value and unrealized P&L, along with their totals."""
+    open_trades = [t for t in trades if t.quantity_outstanding != 0]
+    # Trades entered through the form can have lowercase symbols
+    symbol_quotes = quote_cache.get_quotes(t.symbol.strip().upper() for t in open_trades)
+
+    positions = []
+    totals = {'cost_basis': 0, 'market_value': 0, 'unrealized': 0, 'quoted_count': 0}
+    for t in open_trades:
+        position = {'trade': t, 'quote': symbol_quotes.get(t.symbol.strip().upper())}
+        totals['cost_basis'] += t.cost_basis
+        if position['quote'] is not None:
+            # Negative for short positions, whose cost basis is the
+            # proceeds of the short sale
+            market_value = t.quantity_outstanding * position['quote'].price
+            if t.quantity_outstanding > 0:
+                unrealized = market_value - t.cost_basis
+            else:
+                unrealized = market_value + t.cost_basis
+            position['market_value'] = market_value
+            position['unrealized'] = unrealized
+            totals['market_value'] += market_value
+            totals['unrealized'] += unrealized
+            totals['quoted_count'] += 1
+        positions.append(position)
+    totals['count'] = len(positions)
+    return (positions, totals)
+
+
+def quotes_generation():
+    """Changes every QUOTE_TTL seconds, at the latest when cached quotes
+    are refreshed, for validators of responses including quotes."""
+    if QUOTE_PROVIDER not in ('file', 'sqlite'):
+        return 0
+    return int(datetime.now(pytz.utc).timestamp() // max(QUOTE_TTL, 1))
+
+
+def load_open_trades(account_id):
+    return db_find_where(
+        tradest,
+        and_(tradesc.account_id == account_id, tradesc.quantity_outstanding != 0),
+        tradesc.last_order_date.desc(),
+    )
+
+
+# Attachments
+# ######################################
+
+ATTACHMENT_CHUNK_SIZE = 64 * 1024
+
+# Signature -> content type, uploads are sniffed rather than trusted
+ATTACHMENT_SIGNATURES = (
+    (0, b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (0, b'\xff\xd8\xff', 'image/jpeg'),
+    (0, b'GIF87a', 'image/gif'),
+    (0, b'GIF89a', 'image/gif'),
+    (8, b'WEBP', 'image/webp'),
+)
+
+thumbnail_pool = None
+thumbnail_pool_pid = None
+thumbnails_pending = set()
+thumbnail_pool_lock = threading.Lock()
+
+
+def attachment_path(digest):
+    return os.path.join(ATTACHMENTS_DIR, digest[:2], digest)
+
+
+def thumbnail_path(digest):
+    return os.path.join(ATTACHMENTS_DIR, 'thumbnails', digest[:2], digest + '.jpg')
+
+
+def sniff_content_type(head):
+    for (offset, signature, content_type) in ATTACHMENT_SIGNATURES:
+        if head[offset:offset + len(signature)] == signature:
+            return content_type
+    return None
+
+
+def lock_attachment_content(digest):
+    """Serializes the transactions adding or deleting attachments of the
+    same content. SQLite already does, it has a single writer."""
+    if get_engine().dialect.name == 'postgresql':
+        get_write_db().execute(select([func.pg_advisory_xact_lock(int(digest[:15], 16))]))
+
+
+def store_attachment(trade_id, filename, stream):
+    """Stores an upload under its SHA-256 and adds it to the trade, returns (sha256, error message)."""
+    os.makedirs(ATTACHMENTS_DIR, exist_ok=True)
+    (fd, tmp) = tempfile.mkstemp(prefix='.upload-', dir=ATTACHMENTS_DIR)
+    try:
+        digest = sha256()
+        size = 0
+        head = b''
+        with os.fdopen(fd, 'wb') as f:
+            while True:
+                chunk = stream.read(ATTACHMENT_CHUNK_SIZE)
+                if not chunk:
+                    break
+                head += chunk[:16 - len(head)]
+                digest.update(chunk)
+                size += len(chunk)
+                if size > ATTACHMENT_MAX_SIZE:
+                    return (None, '%s is larger than %g MB' % (
+                        filename, round(ATTACHMENT_MAX_SIZE / 1024 ** 2, 2)))
+                f.write(chunk)
+        content_type = sniff_content_type(head)
+        if content_type is None:
+            return (None, '%s is not a PNG, JPEG, GIF or WebP image' % filename)
+        digest = digest.hexdigest()
+        path = attachment_path(digest)
+        with get_db().begin():
+            lock_attachment_content(digest)
+            db_exec(
+                attachmentst.insert(),
+                trade_id=trade_id,
+                sha256=digest,
+                filename=filename,
+                content_type=content_type,
+                size=size,
+                created_at=datetime.utcnow(),
+            )
+            # Only once the row exists, so it can't be deleted along with the
+            # last other attachment of the same content. Same content when it
+            # exists, replacing it is harmless
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp, path)
+        return (digest, None)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def make_thumbnail(src, dst, size):
+    """Writes a JPEG thumbnail of the `src` image, fitting `size` pixels
+    square, to `dst`. Runs in the thumbnail process pool."""
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    tmp = '%s.%d' % (dst, os.getpid())
+    with Image.open(src) as image:
+        image.thumbnail((size, size))
+        image.convert('RGB').save(tmp, 'JPEG', quality=85)
+    os.replace(tmp, dst)
+
+
+def schedule_thumbnail(digest):
+    """Queues the thumbnail of an attachment in the process pool, without
+    waiting for it. Does nothing without Pillow, when the thumbnail exists
+    or is already queued."""
+    global thumbnail_pool, thumbnail_pool_pid
+    if Image is None or os.path.exists(thumbnail_path(digest)):
+        return
+    with thumbnail_pool_lock:
+        if digest in thumbnails_pending:
+            return
+        # A pool doesn't survive forking (gunicorn --preload)
+        if thumbnail_pool is None or thumbnail_pool_pid != os.getpid():
+            thumbnail_pool = ProcessPoolExecutor(max_workers=THUMBNAIL_WORKERS)
+            thumbnail_pool_pid = os.getpid()
+            thumbnails_pending.clear()
+        thumbnails_pending.add(digest)
+        future = thumbnail_pool.submit(
+            make_thumbnail, attachment_path(digest), thumbnail_path(digest), THUMBNAIL_SIZE)
+
+    def done(future):
+        with thumbnail_pool_lock:
+            thumbnails_pending.discard(digest)
+        if future.exception() is not None:
+            app.logger.error('thumbnail of %s failed: %s', digest, future.exception())
+
+    future.add_done_callback(done)
+
+
+def load_attachment(account_id, attachment_id):
+    result = db_exec(
+        select([attachmentst]).select_from(attachmentst.join(tradest))
+        .where(and_(
+            attachmentsc.attachment_id == attachment_id,
+            tradesc.account_id == account_id,
+        ))
+    )
+    row = result.fetchone()
+    result.close()
+    return objectify(row, AttachmentRow)
+
+
+def delete_attachment(attachment):
+    """Deletes an attachment, and its files once no other attachment has
+    the same content. That is checked and the files removed before the
+    transaction commits, so an upload of the same content waits for it."""
+    with get_db().begin():
+        lock_attachment_content(attachment.sha256)
+        db_exec(attachmentst.delete().where(attachmentsc.attachment_id == attachment.attachment_id))
+        if db_get_where(attachmentst, attachmentsc.sha256 == attachment.sha256) is None:
+            for path in (attachment_path(attachment.sha256), thumbnail_path(attachment.sha256)):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+
+def send_attachment_file(path, content_type):
+    """Sends a stored file, zero-copy through the server's file wrapper,
+    answering conditional and Range requests."""
+    response = send_file(path, mimetype=content_type, conditional=True)
+    # Content addressed, what's at a URL never changes
+    response.headers['Cache-Control'] = 'private, max-age=31536000, immutable'
+    response.headers['X-Content-Type-Options'] = 'nosniff'
+    return response
+
+
+# Search
+# ######################################
+
+SEARCH_LIMIT = 50
+
+# Highlight delimiters, the text is HTML escaped before they become <mark>
+SEARCH_MARK_START = '\u27e6'
+SEARCH_MARK_END = '\u27e7'
+
+# Postgres indexes this expression, queries must repeat it as is
+PG_SEARCH_DOCUMENT = """to_tsvector('english', coalesce(trade.entry_reason, '') || ' ' ||
+    coalesce(trade.exit_reason, '') || ' ' || coalesce(trade.analysis, ''))"""
+
+
+SQLITE_SEARCH_CREATE = (
+    'CREATE VIRTUAL TABLE IF NOT EXISTS trade_search USING fts5('
+    'entry_reason, exit_reason, analysis, tokenize=\'porter unicode61\')'
+)
+PG_SEARCH_CREATE = 'CREATE INDEX IF NOT EXISTS trade_search_idx ON trade USING GIN (%s)' % PG_SEARCH_DOCUMENT
+
+# Created and dropped along with the tables
+event.listen(metadata, 'after_create', DDL(SQLITE_SEARCH_CREATE).execute_if(dialect='sqlite'))
+event.listen(metadata, 'after_create', DDL(PG_SEARCH_CREATE).execute_if(dialect='postgresql'))
+event.listen(metadata, 'before_drop', DDL('DROP TABLE IF EXISTS trade_search').execute_if(dialect='sqlite'))
+
+
+def rebuild_trade_search(conn):
+    """(Re)creates the journal search index: an FTS5 table shadowing the
+    trades' entry/exit reasons and analysis on SQLite (rowid = trade_id), a
+    GIN expression index, maintained by Postgres itself, otherwise."""
+    if conn.dialect.name == 'sqlite':
+        conn.execute('DROP TABLE IF EXISTS trade_search')
+        conn.execute(SQLITE_SEARCH_CREATE)
+        conn.execute(
+            'INSERT INTO trade_search (rowid, entry_reason, exit_reason, analysis) '
+            'SELECT trade_id, entry_reason, exit_reason, analysis FROM trade'
+        )
+    else:
+        conn.execute(PG_SEARCH_CREATE)
+
+
+def sync_trade_search(trade_ids):
+    """Copies the journal text of the given trades to the SQLite search
+    table, for every write path changing them."""
+    if get_engine().dialect.name != 'sqlite':
+        return
+    trade_ids = sorted(set(trade_ids))
+    for i in range(0, len(trade_ids), 500):
+        ids = ', '.join(str(int(trade_id)) for trade_id in trade_ids[i:i + 500])
+        db_exec(text('DELETE FROM trade_search WHERE rowid IN (%s)' % ids))
+        db_exec(text(
+            'INSERT INTO trade_search (rowid, entry_reason, exit_reason, analysis) '
+            'SELECT trade_id, entry_reason, exit_reason, analysis FROM trade '
+            'WHERE trade_id IN (%s)' % ids
+        ))
+
+
+def search_terms(query):
+    return re.findall(r'\w+', query)
+
+
+def search_trades(account_id, query):
+    """Searches the account's trade journals, returns up to SEARCH_LIMIT
+    matching trades, best first, each with a highlighted `snippet`."""
+    terms = search_terms(query)
+    if not terms:
+        return []
+    if get_engine().dialect.name == 'sqlite':
+        # Terms are quoted so user input can't be FTS5 query syntax,
+        # they match as prefixes
+        stmt = text(
+            'SELECT trade.trade_id, trade.symbol, trade.last_order_date, trade.profit, '
+            'trade.commissions, snippet(trade_search, -1, :mark_start, :mark_end, \'…\', 24) AS snippet '
+            'FROM trade_search JOIN trade ON trade.trade_id = trade_search.rowid '
+            'WHERE trade_search MATCH :query AND trade.account_id = :account_id '
+            'ORDER BY bm25(trade_search) LIMIT :limit'
+        ).columns(last_order_date=DateTime)
+        query = ' '.join('"%s"*' % term for term in terms)
+    else:
+        stmt = text(
+            'SELECT trade.trade_id, trade.symbol, trade.last_order_date, trade.profit, '
+            'trade.commissions, ts_headline(\'english\', concat_ws(\' … \', trade.entry_reason, '
+            'trade.exit_reason, trade.analysis), q.query, :headline_options) AS snippet '
+            'FROM trade, plainto_tsquery(\'english\', :query) AS q(query) '
+            'WHERE %s @@ q.query AND trade.account_id = :account_id '
+            'ORDER BY ts_rank_cd(%s, q.query) DESC LIMIT :limit' % (PG_SEARCH_DOCUMENT, PG_SEARCH_DOCUMENT)
+        ).columns(last_order_date=DateTime)
+        query = ' '.join(terms)
+    result = db_exec(
+        stmt,
+        query=query,
+        account_id=account_id,
+        limit=SEARCH_LIMIT,
+        mark_start=SEARCH_MARK_START,
+        mark_end=SEARCH_MARK_END,
+        headline_options='StartSel=%s, StopSel=%s, MaxFragments=2' % (SEARCH_MARK_START, SEARCH_MARK_END),
+    )
+    rows = result.fetchall()
+    result.close()
+    return [dict(row, snippet=highlight_snippet(row['snippet'])) for row in rows]
+
+
+def highlight_snippet(snippet):
+    html = str(Markup.escape(snippet or ''))
+    return Markup(html.replace(SEARCH_MARK_START, '<mark>').replace(SEARCH_MARK_END, '</mark>'))
+
+
+# Assets
+# ######################################
+
+ASSETS_DIR = os.path.join(app.static_folder, 'dist')
+ASSETS_MANIFEST = os.path.join(ASSETS_DIR, 'manifest.json')
+# Built file names change with their content, so they are never revalidated
+ASSET_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+COMPRESSED_ASSET_TYPES = ('.css', '.js', '.svg', '.json',)
+
+
+def minify_asset(ext, content):
+    if rjsmin is None or ext not in ('.css', '.js'):
+        return content
+    minify = rcssmin.cssmin if ext == '.css' else rjsmin.jsmin
+    return minify(content.decode('utf-8')).encode('utf-8')
+
+
+def write_asset(name, content):
+    tmp = os.path.join(ASSETS_DIR, '.%s.%d' % (name, os.getpid()))
+    with open(tmp, 'wb') as f:
+        f.write(content)
+    os.replace(tmp, os.path.join(ASSETS_DIR, name))
+
+
+def build_assets():
+    """Writes every static file, minified, to ASSETS_DIR under a name with
+    its content hash, with a gzip variant for text ones, then the manifest
+    of the built names. Previous builds are kept for pages still linking
+    them. Returns the manifest."""
+    os.makedirs(ASSETS_DIR, exist_ok=True)
+    manifest = {}
+    for name in sorted(os.listdir(app.static_folder)):
+        path = os.path.join(app.static_folder, name)
+        if not os.path.isfile(path):
+            continue
+        (base, ext) = os.path.splitext(name)
+        with open(path, 'rb') as f:
+            content = minify_asset(ext, f.read())
+        built = '%s.%s%s' % (base, sha256(content).hexdigest()[:12], ext)
+        write_asset(built, content)
+        if ext in COMPRESSED_ASSET_TYPES:
+            compressed = io.BytesIO()
+            # No timestamp, so rebuilding the same content gives the same bytes
+            with gzip.GzipFile(fileobj=compressed, mode='wb', compresslevel=9, mtime=0) as f:
+                f.write(content)
+            write_asset(built + '.gz', compressed.getvalue())
+        manifest[name] = built
+    write_asset('manifest.json', json.dumps(manifest, indent=2, sort_keys=True).encode('utf-8'))
+    return manifest
+
+
+def load_assets_manifest():
+    """Returns the built assets by static file name, none in debug mode
+    where the static files are edited."""
+    if DEBUG:
+        return {}
+    try:
+        with open(ASSETS_MANIFEST, encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+assets_manifest = load_assets_manifest()
+
+
+@app.url_defaults
+def fingerprint_static_url(endpoint, values):
+    """Makes url_for('static', filename=...) link the built asset."""
+    if endpoint == 'static' and values.get('filename') in assets_manifest:
+        values['filename'] = 'dist/' + assets_manifest[values['filename']]
+
+
+@app.route('/static/dist/<name>')
+def asset(name):
+    path = os.path.join(ASSETS_DIR, name)
+    if name.startswith('.') or name.endswith('.gz') or name == 'manifest.json' or \
+            not os.path.isfile(path):
+        return abort(404)
+    mimetype = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+    if request.accept_encodings['gzip'] and os.path.isfile(path + '.gz'):
+        response = send_file(path + '.gz', mimetype=mimetype, conditional=True)
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = send_file(path, mimetype=mimetype, conditional=True)
+    response.vary.add('Accept-Encoding')
+    response.headers['Cache-Control'] = ASSET_CACHE_CONTROL
+    return response
+
+
 # Handlers
 # ######################################
 
@@ -291,11 +3028,13 @@ def marketing():
 @app.route('/accounts')
 @sign_in_required
 def accounts():
-    accounts = db_find_where(accountst, accountsc.user_id == g.user.user_id)
-    if len(accounts) == 0:
+    # Not from the accounts cache, another worker may have changed them
+    g.accounts = list(get_user_accounts(g.user.user_id, refresh=True).values())
+    if len(g.accounts) == 0:
         return redirect(url_for('accounts_create'))
-    else:
-        return redirect(url_for('account', account_id=accounts[0].account_id))
+    now = datetime.now(NEW_YORK_TZ).replace(tzinfo=None)
+    (g.stats, g.totals) = portfolio_stats([a.account_id for a in g.accounts], now)
+    return render_template('dashboard.html')
 
 
 @app.route('/accounts/switch')
@@ -319,74 +3058,86 @@ def accounts_create():
         else:
             ins = accountst.insert()
             result = db_exec(ins, user_id=g.user.user_id, name=request.form['name'], cash=cash)
+            accounts_cache.invalidate(g.user.user_id)
             flash('Account created')
             return redirect(url_for('account', account_id=result.inserted_primary_key[0]))
     return render_template('accounts_create.html')
 
 
-def account_stats_for_period(trades, start, end):
-    trades_count = 0
-    profit = 0
-    commissions = 0
-    wins = []
-    losses = []
-
-    trades_for_period = [t for t in trades if t.last_order_date >= start and t.last_order_date <= end]
-    for t in trades_for_period:
-        trades_count += 1
-        profit += t.profit
-        commissions += t.commissions
-        if (t.profit - t.commissions) >= 0:
-            wins.append(t.profit - t.commissions)
-        else:
-            losses.append(t.profit - t.commissions)
-
-
-    return {
-        'trade_count': trades_count,
-        'profit': profit,
-        'commissions': commissions,
-        'profit_without_commissions': profit - commissions,
-        'win_count': len(wins),
-        'loss_count': len(losses),
-        'avg_win': sum(wins) / max(1, len(wins)),
-        'avg_loss': sum(losses) / max(1, len(losses)),
-        'largest_win': max(wins or [0]),
-        'largest_loss': min(losses or [0]),
-        'accuracy': len(wins) / max(1, trades_count),
-    }
-
-
 @app.route('/accounts/<int:account_id>')
 @sign_in_required
 @load_account
 def account(account_id):
-    g.trades = sorted(
-        db_find_where(tradest, tradesc.account_id == account_id),
-        key=lambda o: o.last_order_date,
-        reverse=True,
-    )
+    version = get_account_version(account_id)
     now = datetime.now(NEW_YORK_TZ).replace(tzinfo=None)
 
-    day_start = now.replace(hour=0, minute=0)
-    g.stats_day = account_stats_for_period(g.trades, start=day_start, end=now)
+    def render_stats():
+        stats = account_stats_for_periods(account_id, account_stats_periods(now), now)
+        return render_template('account_stats.html', periods=stats)
+
+    def render_trades():
+        # Further pages are loaded by the browser as it scrolls
+        (trades, next_cursor) = trades_page(tradesc.account_id == account_id)
+        return render_template('account_trades.html', trades=trades, next_cursor=next_cursor)
+
+    g.stats_html = account_fragment(account_id, 'stats', stats_cache_key(version, now), render_stats)
+
+    (g.filters, error) = parse_trade_filters(request.args)
+    if error is not None:
+        flash(error, category='danger')
+        g.filters = {}
+    if g.filters:
+        # Only the unfiltered list is cached
+        (trades, next_cursor) = trades_page(trade_filters_where(account_id, g.filters))
+        g.trades_html = Markup(render_template(
+            'account_trades.html', trades=trades, next_cursor=next_cursor))
+    else:
+        g.trades_html = account_fragment(account_id, 'trades', version, render_trades)
+    # Quotes move on their own, not cached with the fragments
+    (g.positions, g.positions_totals) = mark_to_market(load_open_trades(account_id))
 
-    month_start = now.replace(day=1, hour=0, minute=0)
-    g.stats_mtd = account_stats_for_period(g.trades, start=month_start, end=now)
-    g.stats_month = account_stats_for_period(g.trades, start=now - timedelta(days=30), end=now)
+    return render_template('account.html')
 
-    year_start = now.replace(month=1, day=1, hour=0, minute=0)
-    g.stats_ytd = account_stats_for_period(g.trades, start=year_start, end=now)
-    g.stats_year = account_stats_for_period(g.trades, start=now - timedelta(days=365), end=now)
 
-    return render_template('account.html')
+@app.route('/accounts/<int:account_id>/search')
+@sign_in_required
+@load_account
+def search(account_id):
+    g.query = request.args.get('q', '').strip()
+    g.results = search_trades(account_id, g.query)
+    return render_template('search.html')
+
+
+@app.route('/accounts/<int:account_id>/symbols')
+@sign_in_required
+@load_account
+def symbols(account_id):
+    (g.filters, error) = parse_trade_filters(request.args)
+    if error is not None:
+        flash(error, category='danger')
+        g.filters = {}
+    g.sort = request.args.get('sort', 'worst')
+    if g.sort not in SYMBOL_STATS_SORTS:
+        g.sort = 'worst'
+    g.symbols = symbol_stats(trade_filters_where(account_id, g.filters), g.sort)
+    # Kept by the sort and symbol links
+    g.filter_args = dict((k, request.args[k]) for k in TRADE_FILTERS if request.args.get(k))
+    return render_template('symbols.html')
+
+
+@app.route('/accounts/<int:account_id>/analytics')
+@sign_in_required
+@load_account
+def analytics(account_id):
+    g.analytics = account_analytics(g.account, load_closed_trades(account_id))
+    return render_template('analytics.html')
 
 
 @app.route('/accounts/<int:account_id>/trades/create', methods=['GET', 'POST'])
 @sign_in_required
 @load_account
 def trades_create(account_id):
-    g.trade = Entity(
+    g.trade = TradeRow(
         trade_id=None, account_id=account_id,
         target_entry=None, target_profit=None, target_stop=None
     )
@@ -397,7 +3148,7 @@ def trades_create(account_id):
 
         if len(request.form['entry_reason']) == 0:
             flash('You have to enter a reson for your entry', category='danger')
-        elif len(request.form['symbol']) == 0:
+        elif len(request.form['symbol'].strip()) == 0:
             flash('You have to enter the symbol you are trading', category='danger')
         elif target_entry is None:
             flash('Target entry price entered is not a number', category='danger')
@@ -406,11 +3157,12 @@ def trades_create(account_id):
         elif target_stop is None:
             flash('Target stop price entered is not a number', category='danger')
         else:
+            now = datetime.now(NEW_YORK_TZ).replace(tzinfo=None)
             ins = tradest.insert()
             result = db_exec(
                 ins,
                 account_id=g.account.account_id,
-                symbol=request.form['symbol'],
+                symbol=request.form['symbol'].strip().upper(),
                 target_entry=target_entry,
                 target_profit=target_profit,
                 target_stop=target_stop,
@@ -418,8 +3170,8 @@ def trades_create(account_id):
                 exit_reason='',
                 analysis='',
 
-                first_order_date=datetime.now(NEW_YORK_TZ),
-                last_order_date=datetime.now(NEW_YORK_TZ),
+                first_order_date=now,
+                last_order_date=now,
                 commissions=0,
                 is_short=False,
                 avg_buy_price=0,
@@ -428,7 +3180,14 @@ def trades_create(account_id):
                 quantity=0,
                 quantity_outstanding=0,
                 orders_count=0,
+                buy_count=0,
+                buy_price_total=0,
+                sell_count=0,
+                sell_price_total=0,
             )
+            sync_trade_search([result.inserted_primary_key[0]])
+            refresh_daily_pnl(g.account.account_id, [now])
+            bump_account_version(g.account.account_id)
             flash('Trade created')
             return redirect(url_for(
                 'trade',
@@ -452,7 +3211,7 @@ def trades_edit(account_id, trade_id):
 
         if len(request.form['entry_reason']) == 0:
             flash('You have to enter a reson for your entry', category='danger')
-        elif len(request.form['symbol']) == 0:
+        elif len(request.form['symbol'].strip()) == 0:
             flash('You have to enter the symbol you are trading', category='danger')
         elif target_entry is None:
             flash('Target entry price entered is not a number', category='danger')
@@ -462,7 +3221,7 @@ def trades_edit(account_id, trade_id):
             flash('Target stop price entered is not a number', category='danger')
         else:
             stmt = tradest.update().where(tradesc.trade_id == trade_id).values(
-                symbol=request.form['symbol'],
+                symbol=request.form['symbol'].strip().upper(),
                 target_entry=target_entry,
                 target_profit=target_profit,
                 target_stop=target_stop,
@@ -471,6 +3230,8 @@ def trades_edit(account_id, trade_id):
                 analysis=request.form['analysis'],
             )
             db_exec(stmt)
+            sync_trade_search([trade_id])
+            bump_account_version(account_id)
             flash('Trade updated')
             return redirect(url_for(
                 'trade',
@@ -480,73 +3241,287 @@ def trades_edit(account_id, trade_id):
     return render_template('trades_form.html')
 
 
-def update_trade_computed_fields(trade):
-    orders = sorted(db_find_where(orderst, ordersc.trade_id == trade.trade_id), key=lambda o: o.date)
+TRADE_COMPUTED_FIELDS = (
+    'first_order_date', 'last_order_date', 'commissions', 'is_short',
+    'avg_buy_price', 'avg_sell_price', 'profit', 'quantity',
+    'quantity_outstanding', 'orders_count', 'buy_count', 'buy_price_total',
+    'sell_count', 'sell_price_total', 'cost_basis',
+)
+
+LOTS_PAGE_SIZE = 16
+
+
+def load_trade_orders(trade_id):
+    return db_find_where(orderst, ordersc.trade_id == trade_id, ordersc.date, ordersc.order_id)
+
+
+def match_fill(lots, o):
+    """Matches the fill of order `o` FIFO against `lots`, a deque of the
+    trade's open LotRows oldest first (all long or all short).
+
+    A fill on the opposite side of the lots closes them, from the oldest,
+    and realizes their P&L; what's left of it (or a fill on the same side)
+    opens a new lot. Each lot is opened and closed once, so this is
+    amortized O(1) per fill. Returns (realized P&L, cost basis change)."""
+    is_buy = o.type in BUY_ORDER_TYPES
+    remaining = o.quantity
+    realized = 0
+    cost_change = 0
+    while remaining and lots and lots[0].is_short == is_buy:
+        lot = lots[0]
+        matched = min(remaining, lot.quantity)
+        if lot.is_short:
+            realized += matched * (lot.price - o.price)
+        else:
+            realized += matched * (o.price - lot.price)
+        cost_change -= matched * lot.price
+        lot.quantity -= matched
+        remaining -= matched
+        if lot.quantity == 0:
+            lots.popleft()
+    if remaining:
+        lots.append(LotRow(
+            order_id=o.order_id,
+            date=o.date,
+            is_short=not is_buy,
+            quantity=remaining,
+            price=o.price,
+        ))
+        cost_change += remaining * o.price
+    return (realized, cost_change)
+
+
+def set_trade_avg_prices(trade):
+    # Rounded as the BigInteger columns store them, so a recompute compares
+    # equal to the stored trade
+    trade.avg_buy_price = round(trade.buy_price_total / max(trade.buy_count, 1))
+    trade.avg_sell_price = round(trade.sell_price_total / max(trade.sell_count, 1))
+
+
+def compute_trade_fields(trade, orders):
+    """Computes all of the trade's computed fields from scratch given its
+    orders sorted by date. Returns the open lots left."""
     trade.first_order_date = datetime.now(NEW_YORK_TZ)
     trade.last_order_date = datetime.now(NEW_YORK_TZ)
     trade.orders_count = len(orders)
 
-    buy_prices = []
-    sell_prices = []
     trade.profit = 0
     trade.commissions = 0
     trade.quantity = 0
     trade.quantity_outstanding = 0
+    trade.buy_count = 0
+    trade.buy_price_total = 0
+    trade.sell_count = 0
+    trade.sell_price_total = 0
+    trade.cost_basis = 0
 
+    open_lots = deque()
     for i, o in enumerate(orders):
         trade.commissions += o.commission
-        if o.type == 'buy' or o.type == 'sell_short':
+        if o.type in OPENING_ORDER_TYPES:
             trade.quantity += o.quantity
-        if o.type == 'buy' or o.type == 'buy_to_cover':
-            buy_prices.append(o.price)
+        if o.type in BUY_ORDER_TYPES:
+            trade.buy_count += 1
+            trade.buy_price_total += o.price
             trade.quantity_outstanding += o.quantity
         else:
-            sell_prices.append(o.price)
+            trade.sell_count += 1
+            trade.sell_price_total += o.price
             trade.quantity_outstanding -= o.quantity
 
-        if o.type == 'buy' or o.type == 'sell':
-            trade.is_short = False
-        else:
-            trade.is_short = True
+        trade.is_short = o.type in SHORT_ORDER_TYPES
 
-        if o.type == 'sell' or o.type == 'sell_short':
-            trade.profit += o.quantity * o.price
-        else:
-            trade.profit -= o.quantity * o.price
+        (realized, cost_change) = match_fill(open_lots, o)
+        trade.profit += realized
+        trade.cost_basis += cost_change
 
         if i == 0:
             trade.first_order_date = o.date
         if i == len(orders)-1:
             trade.last_order_date = o.date
 
-    outstanding_value = 0
-    outstanding_value_quantity = trade.quantity_outstanding
-    for o in orders:
-        if outstanding_value_quantity > 0 and o.type == 'sell_short':
-            outstanding_value += min(o.quantity, outstanding_value_quantity) * o.price
-            outstanding_value_quantity -= min(o.quantity, outstanding_value_quantity)
-        if outstanding_value_quantity > 0 and o.type == 'buy':
-            outstanding_value += min(o.quantity, outstanding_value_quantity) * o.price
-            outstanding_value_quantity += min(o.quantity, outstanding_value_quantity)
-
-    trade.profit += outstanding_value
-
-    trade.avg_buy_price = sum(buy_prices) / max(len(buy_prices), 1)
-    trade.avg_sell_price = sum(sell_prices) / max(len(sell_prices), 1)
-
-    stmt = tradest.update().where(tradesc.trade_id == trade.trade_id).values(
-        first_order_date=trade.first_order_date,
-        last_order_date=trade.last_order_date,
-        commissions=trade.commissions,
-        is_short=trade.is_short,
-        avg_buy_price=trade.avg_buy_price,
-        avg_sell_price=trade.avg_sell_price,
-        profit=trade.profit,
-        quantity=trade.quantity,
-        quantity_outstanding=trade.quantity_outstanding,
-        orders_count=len(orders),
+    set_trade_avg_prices(trade)
+    return list(open_lots)
+
+
+def load_front_lots(trade_id, quantity):
+    """Loads the trade's oldest open lots until they cover `quantity`."""
+    lots = deque()
+    covered = 0
+    while covered < quantity:
+        result = db_exec(
+            select([lotst]).where(lotsc.trade_id == trade_id)
+            .order_by(lotsc.date, lotsc.lot_id)
+            .offset(len(lots)).limit(LOTS_PAGE_SIZE)
+        )
+        rows = result.fetchall()
+        result.close()
+        for row in rows:
+            lot = LotRow.from_row(row)
+            lots.append(lot)
+            covered += lot.quantity
+        if len(rows) < LOTS_PAGE_SIZE:
+            break
+    return lots
+
+
+def match_fill_stored_lots(trade, o):
+    """Matches the fill of order `o`, the trade's latest, against its stored
+    open lots, only loading and writing the lots it touches."""
+    outstanding = trade.quantity_outstanding
+    closes = outstanding < 0 if o.type in BUY_ORDER_TYPES else outstanding > 0
+    lots = load_front_lots(trade.trade_id, min(o.quantity, abs(outstanding)) if closes else 0)
+    loaded = dict((lot.lot_id, lot.quantity) for lot in lots)
+
+    (realized, cost_change) = match_fill(lots, o)
+
+    left = dict((lot.lot_id, lot) for lot in lots if lot.lot_id is not None)
+    closed = [lot_id for lot_id in loaded if lot_id not in left]
+    if closed:
+        db_exec(lotst.delete().where(lotsc.lot_id.in_(closed)))
+    for (lot_id, lot) in left.items():
+        if lot.quantity != loaded[lot_id]:
+            db_exec(lotst.update().where(lotsc.lot_id == lot_id).values(quantity=lot.quantity))
+    new_lots = [lot for lot in lots if lot.lot_id is None]
+    if new_lots:
+        db_exec_many(lotst.insert(), trade_lots_values(trade.trade_id, new_lots))
+    return (realized, cost_change)
+
+
+def apply_trade_order_delta(trade, old_order, new_order):
+    """Applies an order change to the trade in place, returns False when it needs a full recompute."""
+    is_append = old_order is None and new_order is not None and \
+        (trade.orders_count == 0 or new_order.date >= trade.last_order_date)
+    if not is_append and trade.quantity_outstanding != 0:
+        return False
+    outstanding_before = trade.quantity_outstanding
+
+    for (o, sign) in ((old_order, -1), (new_order, 1)):
+        if o is None:
+            continue
+        trade.orders_count += sign
+        trade.commissions += sign * o.commission
+        if o.type in OPENING_ORDER_TYPES:
+            trade.quantity += sign * o.quantity
+        if o.type in BUY_ORDER_TYPES:
+            trade.buy_count += sign
+            trade.buy_price_total += sign * o.price
+            trade.quantity_outstanding += sign * o.quantity
+            if not is_append:
+                trade.profit -= sign * o.quantity * o.price
+        else:
+            trade.sell_count += sign
+            trade.sell_price_total += sign * o.price
+            trade.quantity_outstanding -= sign * o.quantity
+            if not is_append:
+                trade.profit += sign * o.quantity * o.price
+
+    # Edits and deletes are exact while flat, the P&L then being the cash flow
+    if not is_append and trade.quantity_outstanding != 0:
+        return False
+
+    if old_order is not None:
+        if trade.orders_count == 0 and new_order is None:
+            return False
+        is_only_order = new_order is not None and trade.orders_count == 1
+        is_boundary = old_order.date <= trade.first_order_date or \
+            old_order.date >= trade.last_order_date
+        if is_boundary and not is_only_order:
+            return False
+    if new_order is not None:
+        if trade.orders_count == 1:
+            trade.first_order_date = new_order.date
+            trade.last_order_date = new_order.date
+            trade.is_short = new_order.type in SHORT_ORDER_TYPES
+        elif new_order.date == trade.last_order_date and old_order is not None:
+            # Ties are ordered by insertion, an edited order isn't the latest
+            return False
+        else:
+            trade.first_order_date = min(trade.first_order_date, new_order.date)
+            if new_order.date >= trade.last_order_date:
+                trade.last_order_date = new_order.date
+                trade.is_short = new_order.type in SHORT_ORDER_TYPES
+
+    if is_append:
+        quantity_outstanding = trade.quantity_outstanding
+        trade.quantity_outstanding = outstanding_before
+        (realized, cost_change) = match_fill_stored_lots(trade, new_order)
+        trade.quantity_outstanding = quantity_outstanding
+        trade.profit += realized
+        trade.cost_basis += cost_change
+
+    set_trade_avg_prices(trade)
+    return True
+
+
+def trade_computed_fields_update(trade):
+    return tradest.update().where(tradesc.trade_id == trade.trade_id).values(
+        **dict((k, getattr(trade, k)) for k in TRADE_COMPUTED_FIELDS)
     )
-    db_exec(stmt)
+
+
+def trade_lots_values(trade_id, lots):
+    values = []
+    for lot in lots:
+        value = dict((k, getattr(lot, k)) for k in lot.__slots__ if k != 'lot_id')
+        value['trade_id'] = trade_id
+        values.append(value)
+    return values
+
+
+def save_trade_computed_fields(trade):
+    db_exec(trade_computed_fields_update(trade))
+
+
+def save_trade_lots(trade_id, lots):
+    """Replaces the trade's stored open lots."""
+    db_exec(lotst.delete().where(lotsc.trade_id == trade_id))
+    if lots:
+        db_exec_many(lotst.insert(), trade_lots_values(trade_id, lots))
+
+
+def lock_trade(where):
+    """Locks the row of the trade matching `where` until the current
+    transaction ends and returns the trade as stored, so the order writes
+    of concurrent requests to a trade apply one after the other."""
+    if get_db().dialect.name == 'sqlite':
+        # No row locks, a write takes the database's write lock right away
+        db_exec(tradest.update().where(where).values(trade_id=tradesc.trade_id))
+    result = db_exec(select([tradest]).where(where).with_for_update())
+    row = result.fetchone()
+    result.close()
+    return objectify(row, TradeRow)
+
+
+def update_trade_computed_fields(trade, old_order=None, new_order=None):
+    """Updates the trade's computed fields after one of its orders changed,
+    incrementally when possible and from all of its orders otherwise. To
+    run in the transaction of the order write, `trade` read by lock_trade."""
+    # The orders and lots must be current, a lagging replica would drift it
+    use_primary()
+    previous_order_date = trade.last_order_date
+    if (old_order is None and new_order is None) or \
+            not apply_trade_order_delta(trade, old_order, new_order):
+        save_trade_lots(trade.trade_id, compute_trade_fields(trade, load_trade_orders(trade.trade_id)))
+    save_trade_computed_fields(trade)
+    refresh_daily_pnl(trade.account_id, [previous_order_date, trade.last_order_date])
+    bump_account_version(trade.account_id)
+
+
+def create_trade_orders(trade, orders):
+    """Adds the parsed `orders` to the trade in one transaction, with a
+    single insert and a single recompute of the trade, returns the trade."""
+    with get_db().begin():
+        trade = lock_trade(tradesc.trade_id == trade.trade_id)
+        previous_order_date = trade.last_order_date
+        db_exec_many(orderst.insert(), [
+            dict(o, trade_id=trade.trade_id, account_id=trade.account_id) for o in orders
+        ])
+        save_trade_lots(trade.trade_id, compute_trade_fields(trade, load_trade_orders(trade.trade_id)))
+        save_trade_computed_fields(trade)
+        refresh_daily_pnl(trade.account_id, [previous_order_date, trade.last_order_date])
+        bump_account_version(trade.account_id)
+    return trade
 
 
 @app.route('/accounts/<int:account_id>/trades/<int:trade_id>', methods=['GET', 'POST'])
@@ -555,7 +3530,8 @@ def update_trade_computed_fields(trade):
 def trade(account_id, trade_id):
     g.trade = db_get_where(tradest, tradesc.trade_id == trade_id and tradesc.account_id == account_id)
     g.orders = sorted(db_find_where(orderst, ordersc.trade_id == trade_id), key=lambda o: o.date)
-    print(g.orders)
+    g.lots = db_find_where(lotst, lotsc.trade_id == trade_id, lotsc.date, lotsc.lot_id)
+    g.attachments = db_find_where(attachmentst, attachmentsc.trade_id == trade_id, attachmentsc.attachment_id)
     return render_template('trade.html')
 
 
@@ -563,42 +3539,24 @@ def trade(account_id, trade_id):
 @sign_in_required
 @load_account
 def orders_create(account_id, trade_id):
-    g.trade = db_get_where(tradest, tradesc.trade_id == trade_id and tradesc.account_id == account_id)
+    where = and_(tradesc.trade_id == trade_id, tradesc.account_id == account_id)
+    g.trade = db_get_where(tradest, where)
     if not g.trade:
         return abort(404)
-    g.order = Entity(
+    g.order = OrderRow(
         order_id=None, account_id=account_id, trade_id=trade_id,
         price=None, commission=None,
     )
     if request.method == 'POST':
-        date = parse_datetime(request.form['date'])
-        quantity = parse_int(request.form['quantity'])
-        price = parse_decimal_to_bigint(request.form['price'])
-        commission = parse_decimal_to_bigint(request.form['commission'])
-
-        if date is None:
-            flash('A valid date is required', category='danger')
-        elif request.form['type'] not in ORDER_TYPES:
-            flash('No hax plz', category='danger')
-        elif quantity is None:
-            flash('Quantity entered is not a number', category='danger')
-        elif price is None:
-            flash('Price entered is not a number', category='danger')
-        elif commission is None:
-            flash('Commission entered is not a number', category='danger')
+        (order, error) = parse_order_fields(request.form)
+        if error is not None:
+            flash(error, category='danger')
         else:
-            ins = orderst.insert()
-            result = db_exec(
-                ins,
-                trade_id=trade_id,
-                account_id=account_id,
-                date=date,
-                type=request.form['type'],
-                quantity=quantity,
-                price=price,
-                commission=commission,
-            )
-            update_trade_computed_fields(g.trade)
+            with get_db().begin():
+                trade = lock_trade(where)
+                result = db_exec(orderst.insert(), trade_id=trade_id, account_id=account_id, **order)
+                update_trade_computed_fields(trade, new_order=OrderRow(
+                    order_id=result.inserted_primary_key[0], **order))
             flash('Order created')
             return redirect(url_for(
                 'trade',
@@ -608,40 +3566,52 @@ def orders_create(account_id, trade_id):
     return render_template('orders_form.html')
 
 
+@app.route('/accounts/<int:account_id>/trades/<int:trade_id>/batch', methods=['GET', 'POST'])
+@sign_in_required
+@load_account
+def orders_batch(account_id, trade_id):
+    g.trade = db_get_where(tradest, and_(tradesc.trade_id == trade_id, tradesc.account_id == account_id))
+    if not g.trade:
+        return abort(404)
+    g.rows = [dict(type='buy') for _ in range(ORDERS_BATCH_ROWS)]
+    if request.method == 'POST':
+        columns = [request.form.getlist(name) for name in ORDER_FIELDS]
+        g.rows = [dict(zip(ORDER_FIELDS, values)) for values in zip(*columns)]
+        # The form always has spare rows, those left blank are ignored
+        numbers = [n for (n, r) in enumerate(g.rows, 1) if r.get('quantity') or r.get('price')]
+        (orders, errors) = parse_orders_batch([g.rows[n - 1] for n in numbers])
+        for (i, error) in errors[:10]:
+            # Numbered as the rows of the form
+            flash(('Order %d: %s' % (numbers[i - 1], error)) if i else error, category='danger')
+        if not errors:
+            create_trade_orders(g.trade, orders)
+            flash('Added %d order(s)' % len(orders))
+            return redirect(url_for('trade', account_id=account_id, trade_id=trade_id))
+    return render_template('orders_batch.html')
+
+
 @app.route('/accounts/<int:account_id>/orders/<int:order_id>/edit', methods=['GET', 'POST'])
 @sign_in_required
 @load_account
 def orders_edit(account_id, order_id):
-    g.order = db_get_where(orderst, ordersc.order_id == order_id and orsersc.account_id == account_id)
+    where = and_(ordersc.order_id == order_id, ordersc.account_id == account_id)
+    g.order = db_get_where(orderst, where)
     if not g.order:
         return abort(404)
     g.trade = db_get_where(tradest, tradesc.trade_id == g.order.trade_id)
     if request.method == 'POST':
-        date = parse_datetime(request.form['date'])
-        quantity = parse_int(request.form['quantity'])
-        price = parse_decimal_to_bigint(request.form['price'])
-        commission = parse_decimal_to_bigint(request.form['commission'])
-
-        if date is None:
-            flash('A valid date is required', category='danger')
-        elif request.form['type'] not in ORDER_TYPES:
-            flash('No hax plz', category='danger')
-        elif quantity is None:
-            flash('Quantity entered is not a number', category='danger')
-        elif price is None:
-            flash('Price entered is not a number', category='danger')
-        elif commission is None:
-            flash('Commission entered is not a number', category='danger')
+        (order, error) = parse_order_fields(request.form)
+        if error is not None:
+            flash(error, category='danger')
         else:
-            stmt = orderst.update().where(ordersc.order_id == g.order.order_id).values(
-                date=date,
-                type=request.form['type'],
-                quantity=quantity,
-                price=price,
-                commission=commission,
-            )
-            db_exec(stmt)
-            update_trade_computed_fields(g.trade)
+            with get_db().begin():
+                trade = lock_trade(tradesc.trade_id == g.order.trade_id)
+                # As stored once the trade is locked, it can have changed since
+                old_order = db_get_where(orderst, where)
+                if not old_order:
+                    return abort(404)
+                db_exec(orderst.update().where(where).values(**order))
+                update_trade_computed_fields(trade, old_order=old_order, new_order=OrderRow(**order))
             flash('Order updated')
             return redirect(url_for(
                 'trade',
@@ -654,16 +3624,118 @@ def orders_edit(account_id, order_id):
 @app.route('/accounts/<int:account_id>/orders/<int:order_id>/delete')
 @sign_in_required
 @load_account
+@primary_required
 def orders_delete(account_id, order_id):
-    where = ordersc.order_id == order_id and ordersc.account_id == account_id
-    order = db_get_where(orderst, where)
-    trade = db_get_where(tradest, tradesc.trade_id == order.trade_id)
-    db_exec(orderst.delete().where(where))
-    update_trade_computed_fields(trade)
+    where = and_(ordersc.order_id == order_id, ordersc.account_id == account_id)
+    with get_db().begin():
+        trade = lock_trade(tradesc.trade_id == select([ordersc.trade_id]).where(where).as_scalar())
+        order = db_get_where(orderst, where)
+        if not order:
+            return abort(404)
+        db_exec(orderst.delete().where(where))
+        update_trade_computed_fields(trade, old_order=order)
     flash('Order deleted.', category='success')
     return redirect(url_for('trade', account_id=account_id, trade_id=order.trade_id))
 
 
+@app.route('/accounts/<int:account_id>/trades/<int:trade_id>/attachments', methods=['POST'])
+@sign_in_required
+@load_account
+def attachments_create(account_id, trade_id):
+    trade = db_get_where(tradest, and_(tradesc.trade_id == trade_id, tradesc.account_id == account_id))
+    if not trade:
+        return abort(404)
+    screenshots = [f for f in request.files.getlist('screenshot') if f.filename]
+    if not screenshots:
+        flash('You have to choose a screenshot', category='danger')
+    attached = 0
+    for f in screenshots:
+        (digest, error) = store_attachment(trade_id, f.filename, f.stream)
+        if error is not None:
+            flash(error, category='danger')
+            continue
+        schedule_thumbnail(digest)
+        attached += 1
+    if attached:
+        flash('%d screenshot(s) attached' % attached)
+    return redirect(url_for('trade', account_id=account_id, trade_id=trade_id))
+
+
+@app.route('/accounts/<int:account_id>/attachments/<int:attachment_id>')
+@sign_in_required
+@load_account
+def attachment(account_id, attachment_id):
+    attachment = load_attachment(account_id, attachment_id)
+    if attachment is None:
+        return abort(404)
+    return send_attachment_file(attachment_path(attachment.sha256), attachment.content_type)
+
+
+@app.route('/accounts/<int:account_id>/attachments/<int:attachment_id>/thumbnail')
+@sign_in_required
+@load_account
+def attachment_thumbnail(account_id, attachment_id):
+    attachment = load_attachment(account_id, attachment_id)
+    if attachment is None:
+        return abort(404)
+    path = thumbnail_path(attachment.sha256)
+    if not os.path.exists(path):
+        # Not generated yet (or no Pillow), the full image stands in
+        schedule_thumbnail(attachment.sha256)
+        return redirect(url_for('attachment', account_id=account_id, attachment_id=attachment_id))
+    return send_attachment_file(path, 'image/jpeg')
+
+
+@app.route('/accounts/<int:account_id>/attachments/<int:attachment_id>/delete', methods=['POST'])
+@sign_in_required
+@load_account
+def attachments_delete(account_id, attachment_id):
+    attachment = load_attachment(account_id, attachment_id)
+    if attachment is None:
+        return abort(404)
+    delete_attachment(attachment)
+    flash('Screenshot deleted.', category='success')
+    return redirect(url_for('trade', account_id=account_id, trade_id=attachment.trade_id))
+
+
+@app.route('/accounts/<int:account_id>/orders/import', methods=['GET', 'POST'])
+@sign_in_required
+@load_account
+def orders_import(account_id):
+    if request.method == 'POST':
+        statement = request.files.get('statement')
+        if not statement or not statement.filename:
+            flash('You have to choose a statement file', category='danger')
+        else:
+            summary = import_orders(account_id, codecs.iterdecode(statement.stream, 'utf-8-sig'))
+            for (line, error) in summary.errors[:10]:
+                flash('Line %d: %s' % (line, error), category='warning')
+            flash('Imported %d order(s) into %d trade(s)' % (summary.orders_count, summary.trades_count))
+            return redirect(url_for('account', account_id=account_id))
+    return render_template('orders_import.html')
+
+
+@app.route('/accounts/<int:account_id>/export/<any(trades, orders):kind>.<any(csv, json):fmt>')
+@sign_in_required
+@load_account
+def export(account_id, kind, fmt):
+    bounds = {'start': None, 'end': None}
+    for name in bounds:
+        if not request.args.get(name):
+            continue
+        bounds[name] = parse_date_bound(request.args[name].strip(), end=name == 'end')
+        if bounds[name] is None:
+            flash('The %s date must be YYYY-MM-DD' % name, category='danger')
+            return redirect(url_for('account', account_id=account_id))
+    query = export_query(kind, account_id, bounds['start'], bounds['end'], request.args.get('symbol'))
+    filename = 'account-%d-%s.%s' % (account_id, kind, fmt)
+    return Response(
+        export_rows(kind, query, fmt, get_read_engine()),
+        mimetype='text/csv' if fmt == 'csv' else 'application/json',
+        headers={'Content-Disposition': 'attachment; filename=%s' % filename},
+    )
+
+
 @app.route('/signin', methods=['GET', 'POST'])
 @sign_out_required
 def sign_in():
@@ -701,12 +3773,14 @@ def sign_up():
             error = 'The username is already taken'
         else:
             ins = users.insert()
-            db_exec(
+            result = db_exec(
                 ins,
                 username=request.form['username'],
                 email=request.form['email'].lower(),
                 password=generate_password_hash(request.form['password']),
             )
+            users_cache.invalidate(result.inserted_primary_key[0])
+            accounts_cache.invalidate(result.inserted_primary_key[0])
             flash('You were successfully registered and can login now')
             return redirect(url_for('sign_in'))
     return render_template('sign_up.html', error=error)
@@ -721,5 +3795,26 @@ def sign_out():
 # Run
 # ######################################
 
+def load_templates():
+    """Loads every template into the Jinja environment, from the bytecode
+    cache when it has them. Returns how many were loaded."""
+    names = [n for n in app.jinja_env.list_templates() if n.endswith('.html')]
+    for name in names:
+        app.jinja_env.get_template(name)
+    return len(names)
+
+
+def create_app():
+    """Application factory for WSGI servers, e.g.
+    `gunicorn 'trade_log.trade_log:create_app()' --preload`.
+
+    Routes are registered on `app` at import, this readies it to serve:
+    templates are loaded up front so no request compiles one (forked
+    workers share them with --preload). The engine is left to be created
+    on first use, in the worker."""
+    load_templates()
+    return app
+
+
 if __name__ == '__main__':
     app.run(debug=DEBUG)